@@ -0,0 +1,131 @@
+import os, json, time, logging
+from halo.loom import Loom
+
+"""
+Durable loom events. A Loom with an outbox appends what was emitted to it
+when it finishes, before calling the finish functions (one entry per
+finish, in the loom's transaction when it has one), and consumers in other
+processes replay the entries into their own looms:
+
+    loom = Loom(outbox=outbox, meta={'account_id': account.id},
+                transaction=db.database.transaction)
+    relationships.set_loom(loom).refresh(api)
+    loom.finish()
+
+    # consumer process
+    def bind(loom, meta):
+        History.set_loom(loom, meta['account_id'])
+    replay(outbox, 'history', bind)
+
+An outbox is anything with append(events, meta), read(consumer, limit)
+which returns the entries consumer hasn't acked yet, and ack(consumer,
+position) to ack one of them. FileOutbox is a local write ahead log,
+halo.services.models.LoomOutbox keeps entries in the database. Delivery is
+at least once, consumers have to tolerate seeing an entry again if they die
+before acking it, or if the finish functions fail without a transaction
+and the next refresh emits the same events again.
+"""
+
+def _default(obj):
+    # id arrays, sets
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return list(obj)
+
+def dumps_entry(events, meta=None):
+    return json.dumps({
+        'created': int(time.time()),
+        'meta': meta,
+        'events': [[name, args, kwargs] for name, args, kwargs in events],
+    }, default=_default, separators=(',', ':'))
+
+def loads_entry(data):
+    """Returns (meta, events)"""
+    entry = json.loads(data)
+    return entry['meta'], [(name, args, kwargs) \
+                           for name, args, kwargs in entry['events']]
+
+class FileOutbox(object):
+    """Append only JSON lines file, each line is one entry. Entries are
+    written with a single write to a file opened for appending, so several
+    processes can append to the same file. Positions are byte offsets and
+    consumer offsets are kept next to the log (path.consumer.offset).
+    """
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+
+    def append(self, events, meta=None):
+        line = dumps_entry(events, meta) + '\n'
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, line)
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def read(self, consumer, limit=100):
+        """Returns up to limit [(position after entry, meta, events)] after
+        the consumer's offset. Entries are appended in order so acking one
+        acks the ones before it.
+        """
+        position = self.offset(consumer)
+        entries = []
+        if not os.path.exists(self.path):
+            return entries
+
+        with open(self.path, 'rb') as f:
+            f.seek(position)
+            while len(entries) < limit:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    # end of file or an entry that's still being written
+                    break
+                position += len(line)
+                try:
+                    meta, events = loads_entry(line)
+                except ValueError:
+                    logging.error('Skipping corrupt outbox entry at %s of %s' % \
+                                  (position - len(line), self.path))
+                    continue
+                entries.append((position, meta, events))
+
+        return entries
+
+    def _offset_path(self, consumer):
+        return '%s.%s.offset' % (self.path, consumer)
+
+    def offset(self, consumer):
+        try:
+            with open(self._offset_path(consumer)) as f:
+                return int(f.read() or 0)
+        except IOError:
+            return 0
+
+    def ack(self, consumer, position):
+        path = self._offset_path(consumer)
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(position))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+
+def replay(outbox, consumer, bind, limit=100, loom_class=Loom, **kwargs):
+    """Replays the entries consumer hasn't acked yet. bind(loom, meta) is
+    called with a fresh loom (loom_class(**kwargs)) for each entry to bind
+    the handlers, then the entry's events are emitted and the loom is
+    finished. Returns the number of entries replayed.
+    """
+    entries = outbox.read(consumer, limit)
+
+    for position, meta, events in entries:
+        loom = loom_class(**kwargs)
+        bind(loom, meta)
+        for name, args, event_kwargs in events:
+            loom.emit(name, *args, **event_kwargs)
+        loom.finish()
+        outbox.ack(consumer, position)
+
+    return len(entries)
@@ -1,8 +1,9 @@
 import logging, json
 from datetime import datetime
 from peewee import InsertQuery, UpdateQuery, MySQLDatabase
-from peewee import Field, CharField, TextField, DateTimeField
-from peewee import Node, Model, Param, Expression, OP_EQ, CommaClause
+from peewee import Field, CharField, TextField, DateTimeField, BlobField
+from peewee import Node, Model, Param, Expression, OP_EQ, CommaClause, SQL
+from halo.util.ringbuffer import RingBuffer
 
 #
 # DB OPERATIONS
@@ -15,12 +16,23 @@ class InsertIgnoreQuery(InsertQuery):
         return (query, params)
 
 class InsertUpdateQuery(InsertQuery):
-    def __init__(self, model_class, insert=None):
+    """With rows (a multi-row insert) the fields in update (names, defaults
+    to all fields of the first row) are set to the inserted values.
+    """
+    def __init__(self, model_class, insert=None, rows=None, update=None):
         #assert isinstance(model_class._meta.database, MySQLDatabase), \
         #        'An insert update is only supported by MySQL'
 
-        self._update = insert
-        super(InsertUpdateQuery, self).__init__(model_class, insert)
+        if rows is None:
+            self._update = insert
+        else:
+            fields = model_class._meta.fields
+            quote = model_class._meta.database.compiler().quote
+            self._update = dict(
+                (fields[f], SQL('VALUES(%s)' % quote(fields[f].db_column))) \
+                for f in (update or rows[0].keys()))
+
+        super(InsertUpdateQuery, self).__init__(model_class, insert, rows)
 
     def sql(self):
         query, params = super(InsertUpdateQuery, self).sql()
@@ -60,12 +72,68 @@ def insert_update(model_class, **insert):
     """Only supported by mysql"""
     execute_query(model_class, InsertUpdateQuery, **insert)
 
+# mysql's max_allowed_packet defaults to 1MB (4MB since 5.6)
+MAX_PACKET_SIZE = 1 << 20
+MAX_ROWS = 1000
+
+def _row_size(row):
+    # rough size of a row in a statement (values plus separators)
+    return sum(len(v) if isinstance(v, basestring) else 20 \
+               for v in row.itervalues()) + 4 * len(row)
+
+def iter_chunks(rows, max_packet_size=MAX_PACKET_SIZE, max_rows=MAX_ROWS):
+    """Group an iterable of rows (dicts) into lists that should fit in one
+    statement. Rows are consumed lazily so a generator can be passed.
+    """
+    chunk = []
+    size = 0
+
+    for row in rows:
+        row_size = _row_size(row)
+        if chunk and (size + row_size > max_packet_size or \
+                      len(chunk) >= max_rows):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(row)
+        size += row_size
+
+    if chunk:
+        yield chunk
+
+def execute_bulk_query(model_class, query_class, rows,
+                       max_packet_size=MAX_PACKET_SIZE, max_rows=MAX_ROWS,
+                       **kwargs):
+    """Insert rows (dicts of field name to value, all with the same keys)
+    using chunked multi-row statements. Returns the number of rows.
+    """
+    count = 0
+    for chunk in iter_chunks(rows, max_packet_size, max_rows):
+        query_class(model_class, rows=chunk, **kwargs).execute()
+        count += len(chunk)
+    return count
+
+def bulk_insert(model_class, rows, **kwargs):
+    return execute_bulk_query(model_class, InsertQuery, rows, **kwargs)
+
+def bulk_insert_ignore(model_class, rows, **kwargs):
+    return execute_bulk_query(model_class, InsertIgnoreQuery, rows, **kwargs)
+
+def bulk_insert_update(model_class, rows, update=None, **kwargs):
+    """Only supported by mysql. update is a list of the field names to update
+    on duplicate keys (defaults to all).
+    """
+    return execute_bulk_query(model_class, InsertUpdateQuery, rows,
+                              update=update, **kwargs)
+
 #
 # FIELDS
 #
 
 MySQLDatabase.register_fields({
     'timestamp_updated': 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP',
+    'longblob': 'LONGBLOB',
+    'longtext': 'LONGTEXT',
 })
 
 class TimestampUpdatedField(DateTimeField):
@@ -95,6 +163,35 @@ class JSONTextField(TextField):
     def python_value(self, value):
         return json.loads(value) if value else value
 
+class LongTextField(TextField):
+    """LONGTEXT fields have a max length of 4GB"""
+    db_field = 'longtext'
+
+class RingBufferField(BlobField):
+    """Fixed capacity series of ints stored as packed int32s (see
+    halo.util.ringbuffer). Lists are accepted, and JSON lists are read so a
+    JSONField column can be converted in place, after it's been altered to
+    a BLOB (see halo.services.models.DailyCounts.migrate_ring_buffers).
+    """
+    def __init__(self, capacity=60, *args, **kwargs):
+        self.capacity = capacity
+        super(RingBufferField, self).__init__(*args, **kwargs)
+
+    def db_value(self, value):
+        if value is None:
+            return value
+        if not isinstance(value, RingBuffer):
+            value = RingBuffer(self.capacity, value)
+        return super(RingBufferField, self).db_value(value.to_bytes())
+
+    def python_value(self, value):
+        if value is None:
+            return value
+        value = str(value)
+        if value.startswith('['):
+            return RingBuffer(self.capacity, json.loads(value))
+        return RingBuffer.from_bytes(value, self.capacity)
+
 #
 # UTIL
 #
@@ -137,4 +234,5 @@ if __name__ == '__main__':
         update = DateTimeField()
 
     execute_query(TestModel, TestQuery, update=datetime.now())
+    TestQuery(TestModel, rows=[{'update': datetime.now()}] * 2).execute()
 
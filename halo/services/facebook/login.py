@@ -1,6 +1,7 @@
-import logging, urllib, urllib2, cgi
+import logging, urllib, cgi
 from flask import request, current_app, json
 import facebook
+from halo.util import http
 
 def trim_profile(profile):
     return profile
@@ -20,12 +21,12 @@ def redirect_or_access_token(
             client_secret=config['FACEBOOK_APP_SECRET'],
             code=oauth_code,
         )
-        response = cgi.parse_qs(urllib2.urlopen(
+        response = cgi.parse_qs(http.urlopen(
             'https://graph.facebook.com/oauth/access_token?' +
             urllib.urlencode(args)).read())
 
         access_token = response['access_token'][-1]
-        profile = json.load(urllib2.urlopen(
+        profile = json.load(http.urlopen(
             'https://graph.facebook.com/me?' + \
             urllib.urlencode(dict(access_token=access_token, fields=fields))))
         return (access_token, None, profile)
@@ -2,6 +2,10 @@ import inspect
 from flask import current_app
 from instagram import client, subscriptions, InstagramAPIError, \
         InstagramClientError
+from halo.util import http
+
+# keep-alive connections for python-instagram's requests
+http.patch_instagram()
 
 """
 Instagram doesn't send back rate limit info with responses like twitter. So
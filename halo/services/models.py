@@ -1,26 +1,111 @@
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import defaultdict
 from dateutil.tz import tzoffset
 import pytz
+from peewee import *
+from halo.peewee_ext import bulk_insert_update, LongTextField, \
+        RingBufferField
+from halo.outbox import dumps_entry, loads_entry
 from app import db
 
+# tzoffset instances by utc offset
+_timezones = {}
+
+def local_timezone(utc_offset):
+    utc_offset = utc_offset or 0
+    tz = _timezones.get(utc_offset)
+    if tz is None:
+        tz = _timezones[utc_offset] = tzoffset(None, utc_offset)
+    return tz
+
+class DailyMetrics(db.Model):
+    """One row per account, metric, and local day. Can be used as the
+    METRICS_MODEL of DailyCounts subclasses for range and cross-account
+    queries.
+    """
+    account_id = BigIntegerField()
+    metric = CharField(max_length=30)
+    local_day = DateField()
+    value = BigIntegerField(null=True)
+
+    class Meta:
+        db_table = 'daily_metrics'
+        indexes = (
+            (('account_id', 'metric', 'local_day'), True),
+            # cross-account queries
+            (('metric', 'local_day'), False),
+        )
+
+    @classmethod
+    def upsert(cls, account_id, values):
+        """values is a list of (metric, local_day, value). Values are the
+        day's totals so writing them again (e.g. a retry) changes nothing.
+        """
+        q = ('INSERT INTO %s (account_id, metric, local_day, value) ' + \
+             'VALUES %s ON DUPLICATE KEY UPDATE value=VALUES(value)') % \
+                (cls._meta.db_table, ','.join(['(%s,%s,%s,%s)'] * len(values)))
+        params = []
+        for metric, local_day, value in values:
+            params.extend([account_id, metric, local_day, value])
+
+        db.database.execute_sql(q, params)
+
+    @classmethod
+    def series(cls, account_id, metric, start, end):
+        """Values from start to end (local dates, inclusive) with None for
+        days without a row.
+        """
+        rows = cls.select(cls.local_day, cls.value).where(
+            (cls.account_id == account_id) & \
+            (cls.metric == metric) & \
+            (cls.local_day >= start) & \
+            (cls.local_day <= end)).tuples()
+        values = dict(rows)
+        return [values.get(start + timedelta(days=i)) \
+                for i in range((end - start).days + 1)]
+
+    @classmethod
+    def changed_by(cls, metric, start, end, ratio):
+        """Returns (account_id, start value, end value) of accounts whose
+        metric changed by at least ratio (e.g. -0.01 for a 1% drop) from
+        the start day to the end day.
+        """
+        table = cls._meta.db_table
+        op = '<=' if ratio < 0 else '>='
+        q = ('SELECT a.account_id, a.value, b.value FROM %s a JOIN %s b ' + \
+             'ON b.account_id=a.account_id AND b.metric=a.metric ' + \
+             'WHERE a.metric=%%s AND a.local_day=%%s AND b.local_day=%%s ' + \
+             'AND a.value>0 AND b.value %s a.value*%%s') % (table, table, op)
+        cur = db.database.execute_sql(q, (metric, start, end, 1 + ratio))
+        return cur.fetchall()
+
 class DailyCounts(db.Model):
     MAX_LENGTH = 60
     RESET_DELTA = 8
 
-    # your field needs to accept a list in python (e.g. JSONField)
+    # set to DailyMetrics (or a model like it) to also upsert every value
+    # (the day's total for cumulative values) into a table with a row per day
+    METRICS_MODEL = None
+
+    # your field needs to accept a list in python (e.g. JSONField, or
+    # RingBufferField with a capacity of MAX_LENGTH)
     # you also need an additional DateTimeField called fieldname_updated
 
     def add_cumulative(self, utc_offset=0, **kwargs):
         return self.add_values(utc_offset, cumulative=True, **kwargs)
 
-    def add_values(self, utc_offset=0, cumulative=False, **kwargs):
+    def add_values(self, utc_offset=0, cumulative=False, now=None, **kwargs):
         """Pass field to be updated as a kwargs (eg. follower_count=213)
         """
-        now = datetime.now()
+        now = now or datetime.now()
         changed = False
+        metrics = []
 
         for field_name, value in kwargs.iteritems():
+            if self.METRICS_MODEL and not value is None:
+                metrics.append(field_name)
+
             updated_field_name = field_name + '_updated'
             updated = getattr(self, updated_field_name)
 
@@ -49,11 +134,23 @@ class DailyCounts(db.Model):
 
                 if delta < 0:
                     # shouldn't happen
-                    loagging.warning('DailyCounts delta less than zero')
+                    logging.warning('DailyCounts delta less than zero')
 
                 if not old_value == values[-1]:
                     changed = True
             else:
+                # values that are about to be pushed out of the series
+                if delta >= self.RESET_DELTA:
+                    expired = len(values)
+                else:
+                    expired = len(values) + delta - self.MAX_LENGTH
+
+                if expired > 0:
+                    first_day = self.local_date(updated, utc_offset) - \
+                            timedelta(days=len(values)-1)
+                    self.expire_values(field_name, first_day,
+                                       values[:expired])
+
                 if delta >= self.RESET_DELTA:
                     # too many days have passed since last update so
                     # reset the values
@@ -76,17 +173,51 @@ class DailyCounts(db.Model):
 
             setattr(self, updated_field_name, now)
 
+        if metrics:
+            day = self.local_date(now, utc_offset)
+            self.METRICS_MODEL.upsert(self.get_id(), [
+                (field_name, day, getattr(self, field_name)[-1]) \
+                for field_name in metrics])
+
         return changed
 
+    def series(self, field_name, days=None, utc_offset=0):
+        """Returns the last days values of a series (ending with the day of
+        the last update), read from METRICS_MODEL if it's set.
+        """
+        if not self.METRICS_MODEL:
+            values = getattr(self, field_name) or []
+            return list(values)[-days:] if days else list(values)
+
+        updated = getattr(self, field_name + '_updated')
+        if not updated:
+            return []
+
+        end = self.local_date(updated, utc_offset)
+        start = end - timedelta(days=(days or self.MAX_LENGTH) - 1)
+        return self.METRICS_MODEL.series(self.get_id(), field_name,
+                                         start, end)
+
+    def expire_values(self, field_name, first_day, values):
+        """Called with the values (first_day being the local date of the
+        first one) that are about to be dropped from a series. Override to
+        keep them somewhere (see RelationshipStats).
+        """
+        pass
+
+    @classmethod
+    def local_date(cls, when, utc_offset):
+        # assumes when is in UTC
+        return when.replace(tzinfo=pytz.utc).\
+                astimezone(local_timezone(utc_offset)).date()
+
     @classmethod
     def day_delta(cls, when, utc_offset, now=None):
         """Return days since specified time adjusted for timezone.
         A negative value indicates earlier time.
         """
-        utc_offset = utc_offset or 0
-
         # this assumes that utc_offset accounts for DST
-        local_tz = tzoffset(None, utc_offset)
+        local_tz = local_timezone(utc_offset)
         # astimezone is required or else datetime not adjusted
         when = when.replace(tzinfo=pytz.utc).\
                 astimezone(local_tz)
@@ -101,3 +232,191 @@ class DailyCounts(db.Model):
         #logging.debug(now.date())
         #logging.debug(when.date())
         return (now.date() - when.date()).days
+
+    @classmethod
+    def series_fields(cls):
+        return [name for name in cls._meta.fields \
+                if name + '_updated' in cls._meta.fields]
+
+    @classmethod
+    def migrate_ring_buffers(cls, alter=True):
+        """Migrate series columns from JSONField (VARCHAR) to
+        RingBufferField (BLOB), binary data can't be written to a utf8
+        VARCHAR. JSON lists are still read so rewriting the rows can also be
+        left to their next update. Returns the number of rows rewritten.
+        """
+        table = cls._meta.db_table
+        pk = cls._meta.primary_key
+        fields = [cls._meta.fields[name] for name in cls.series_fields() \
+                  if isinstance(cls._meta.fields[name], RingBufferField)]
+
+        if alter:
+            for field in fields:
+                db.database.execute_sql('ALTER TABLE %s MODIFY %s BLOB NULL' % \
+                                        (table, field.db_column))
+
+        count = 0
+        for field in fields:
+            q = 'UPDATE %s SET %s=%%s WHERE %s=%%s' % \
+                    (table, field.db_column, pk.db_column)
+            query = cls.select(pk, field).where(fn.LEFT(field, 1) == '[')
+
+            for row in query:
+                db.database.execute_sql(q, (
+                    field.db_value(getattr(row, field.name)), row.get_id()))
+                count += 1
+
+        return count
+
+    @classmethod
+    def rollover(cls, rows, now=None, batch_size=1000):
+        """Pad the series of many records up to today so they stay aligned
+        without waiting for each record's own update. rows is an iterable of
+        (record, utc_offset). Changed records are written with multi-row
+        updates. Returns the number of changed records.
+        """
+        now = now or datetime.now()
+        fields = cls.series_fields()
+        count = 0
+        batch = defaultdict(list)
+        size = 0
+
+        for row, utc_offset in rows:
+            batch[utc_offset or 0].append(row)
+            size += 1
+            if size >= batch_size:
+                count += cls._rollover_batch(batch, fields, now)
+                batch.clear()
+                size = 0
+
+        if size:
+            count += cls._rollover_batch(batch, fields, now)
+
+        return count
+
+    @classmethod
+    def _rollover_batch(cls, batch, fields, now):
+        changed = []
+
+        for utc_offset, rows in batch.iteritems():
+            for row in rows:
+                # a None value pads without adding a value for today
+                values = dict((field, None) for field in fields \
+                              if getattr(row, field + '_updated'))
+                if row.add_values(utc_offset, now=now, **values):
+                    changed.append(row)
+
+        if changed:
+            cls.bulk_save(changed, fields)
+
+        return len(changed)
+
+    @classmethod
+    def bulk_save(cls, rows, fields=None):
+        fields = fields or cls.series_fields()
+        columns = fields + [field + '_updated' for field in fields]
+        pk = cls._meta.primary_key.name
+
+        bulk_insert_update(cls, (dict((column, getattr(row, column)) \
+                                      for column in [pk] + columns) \
+                                 for row in rows), update=columns)
+
+class LoomOutbox(db.Model):
+    """Loom outbox (see halo.outbox) that keeps entries in the database so
+    they're appended in the same transaction as the loom's finish functions.
+    Positions are ids.
+
+    Ids are assigned on insert but rows only become visible when their
+    transaction commits, which can be after rows with higher ids, so
+    consumers ack entries one at a time (LoomOutboxAcks) instead of
+    remembering the highest id they've seen. LoomOutboxOffsets keeps the id
+    below which a consumer has acked every entry, it's only moved past
+    entries created more than GRACE ago (longer than any transaction).
+    """
+    GRACE = timedelta(minutes=10)
+
+    created = DateTimeField(default=datetime.now)
+    data = LongTextField()
+
+    class Meta:
+        db_table = 'loom_outbox'
+
+    @classmethod
+    def append(cls, events, meta=None):
+        cls.create(data=dumps_entry(events, meta))
+
+    @classmethod
+    def _unacked(cls, consumer, offset):
+        acked = LoomOutboxAcks.select(LoomOutboxAcks.entry).where(
+            (LoomOutboxAcks.consumer == consumer) & \
+            (LoomOutboxAcks.entry > offset))
+        return (cls.id > offset) & ~(cls.id << acked)
+
+    @classmethod
+    def read(cls, consumer, limit=100):
+        offset = cls.compact(consumer)
+        query = cls.select().where(cls._unacked(consumer, offset))\
+                .order_by(cls.id).limit(limit)
+        return [(row.id,) + loads_entry(row.data) for row in query]
+
+    @classmethod
+    def offset(cls, consumer):
+        position = LoomOutboxOffsets.select(LoomOutboxOffsets.position)\
+                .where(LoomOutboxOffsets.consumer == consumer).scalar()
+        return position or 0
+
+    @classmethod
+    def ack(cls, consumer, position):
+        bulk_insert_update(LoomOutboxAcks,
+                           [dict(consumer=consumer, entry=position)])
+
+    @classmethod
+    def compact(cls, consumer):
+        """Move the consumer's offset past the entries it has acked that
+        are older than GRACE and delete their acks. Returns the offset.
+        """
+        offset = cls.offset(consumer)
+        first = cls.select(fn.Min(cls.id))\
+                .where(cls._unacked(consumer, offset)).scalar()
+        query = cls.select(fn.Max(cls.id)).where(
+            (cls.id > offset) & (cls.created < datetime.now() - cls.GRACE))
+        if first is not None:
+            query = query.where(cls.id < first)
+        position = query.scalar()
+
+        if position is not None:
+            bulk_insert_update(LoomOutboxOffsets,
+                               [dict(consumer=consumer, position=position)])
+            LoomOutboxAcks.delete().where(
+                (LoomOutboxAcks.consumer == consumer) & \
+                (LoomOutboxAcks.entry <= position)).execute()
+            offset = position
+
+        return offset
+
+    @classmethod
+    def purge(cls, before):
+        """Delete entries created before datetime before"""
+        return cls.delete().where(cls.created < before).execute()
+
+class LoomOutboxOffsets(db.Model):
+    consumer = CharField(max_length=50, primary_key=True)
+    position = BigIntegerField()
+
+    class Meta:
+        db_table = 'loom_outbox_offsets'
+
+class LoomOutboxAcks(db.Model):
+    """Entries acked past a consumer's offset"""
+    consumer = CharField(max_length=50)
+    entry = BigIntegerField()
+
+    class Meta:
+        db_table = 'loom_outbox_acks'
+        primary_key = CompositeKey('consumer', 'entry')
+
+if __name__ == '__main__':
+    DailyMetrics.create_table(fail_silently=True)
+    LoomOutbox.create_table(fail_silently=True)
+    LoomOutboxOffsets.create_table(fail_silently=True)
+    LoomOutboxAcks.create_table(fail_silently=True)
@@ -2,19 +2,71 @@ import math, time, urllib, json, logging
 from flask import current_app
 from tweepy import OAuthHandler, API, TweepError, Cursor
 from tweepy.parsers import JSONParser
+from halo.util.ids import id_array, sort_id_array
+from halo.util import http
 from errors import TwitterAPIRateLimited, TwitterAPIPreRateLimited
+from ratelimits import MemoryRateLimitStore
+from lookup import LookupCoalescer
+from parsers import ProjectionParser
 
 try:
     import gevent
 except ImportError:
     pass
 
+# keep-alive connections for tweepy's requests
+http.patch_tweepy()
+
 class TweepyProxy(object):
     """We can't just override tweepy's API because the method that
     makes the request is inside of an inner class. Will check twitter
-    rate limit status before making a request.
+    rate limit status before making a request. With integer_ids relationship
+    ids are fetched as ints and collected into arrays instead of lists of
+    strings. Pass a rate_limit_store (see ratelimits) to share rate limits
+    with the proxies of other processes.
+
+    With max_wait (seconds) calls without quota wait for the reset when it
+    is less than max_wait away instead of raising TwitterAPIPreRateLimited
+    (the error's retry_at says when to try again). Each endpoint's remaining
+    quota is then tracked as a token bucket, in a MemoryRateLimitStore if
+    no rate_limit_store is passed.
+
+    Pass a profile_cache (see profilecache) to have ordered_lookup_users
+    return cached trimmed profiles (without following and status) and only
+    look up the users that aren't.
+
+    Pass user_fields (e.g. PROJECTED_USER_FIELDS) to only parse those fields
+    of the users returned by user endpoints (see ProjectionParser).
     """
-    def __init__(self, account, rate_limit_buffer=1, **kwargs):
+    # fields trim_users keeps
+    USER_FIELDS = frozenset([
+        'name',
+        'location',
+        'profile_image_url',
+        'created_at',
+        'url',
+        'id',
+        'protected',
+        'followers_count',
+        'lang',
+        'verified',
+        'description',
+        'friends_count',
+        'statuses_count',
+        'screen_name',
+        'following',
+        'status',
+    ])
+    # fields to parse with ProjectionParser, without the nested status
+    # so users are projected while they're decoded
+    PROJECTED_USER_FIELDS = USER_FIELDS - frozenset(['status'])
+
+    # shared by the proxies of a process
+    lookup_coalescer = LookupCoalescer()
+
+    def __init__(self, account, rate_limit_buffer=1, integer_ids=False,
+                 rate_limit_store=None, max_wait=None, profile_cache=None,
+                 user_fields=None, **kwargs):
 
         auth = OAuthHandler(
             current_app.config['TWITTER_CONSUMER_KEY'],
@@ -24,7 +76,16 @@ class TweepyProxy(object):
                               account.access_token_secret)
 
         self.rate_limit_buffer = rate_limit_buffer
-        kwargs['parser'] = JSONParser()
+        self.integer_ids = integer_ids
+        self.rate_limit_store = rate_limit_store
+        self.max_wait = max_wait
+        self.profile_cache = profile_cache
+        self.account_id = account.id
+
+        if max_wait is not None and rate_limit_store is None:
+            self.rate_limit_store = MemoryRateLimitStore()
+        kwargs['parser'] = ProjectionParser(user_fields) if user_fields \
+                else JSONParser()
         kwargs['api_root'] = '/1.1'
         self.api = API(auth, **kwargs)
         self.rate_limits = {}
@@ -41,16 +102,30 @@ class TweepyProxy(object):
 
     def update_rate_limits(self, endpoint):
         if getattr(self.api, 'last_response', None):
-            self.rate_limits[endpoint] = {
+            ratelimit = {
                 'limit': self.ratelimit_limit,
                 'remaining': self.ratelimit_remaining,
                 'reset': self.ratelimit_reset,
             }
 
+            if self.rate_limit_store is not None:
+                # see the "me" adjustment in __getattr__
+                if endpoint == 'me' and ratelimit['remaining'] >= 165:
+                    ratelimit['remaining'] -= 165
+                ratelimit = self.rate_limit_store.update(
+                    self.account_id, endpoint, ratelimit)
+
+            self.rate_limits[endpoint] = ratelimit
+
     def load_rate_limits(self, account):
         rate_limits = account.rate_limits
         self.rate_limits.update(rate_limits)
 
+        if self.rate_limit_store is not None:
+            for endpoint, ratelimit in rate_limits.iteritems():
+                self.rate_limit_store.update(self.account_id, endpoint,
+                                             ratelimit)
+
     def save_rate_limits(self, account):
         account.rate_limits = self.rate_limits
 
@@ -82,47 +157,75 @@ class TweepyProxy(object):
         if not callable(attr): return attr
 
         def func(*args, **kwargs):
-            # FIXME: assumes we're doing an authenticated rate
-            # limited call
-            # some aren't (like unfollowing)
-            #logging.warning(name)
-            #logging.warning(self.rate_limits)
-
-            if name in self.rate_limits:
-                ratelimit = self.rate_limits[name]
-
-                # the twitter api is misreporting the rate limits of
-                # 'me' endpoint as 180 when it seems to be 15
-                if name == 'me' and ratelimit['remaining'] >= 165:
-                    logging.debug('adjusting rate limit for the ' + \
-                                  '"me" endpoint')
-                    ratelimit['remaining'] -= 165
-
-                #print ratelimit['remaining']
-                #print ratelimit['reset']
-                #print time.time()
-
-                if ratelimit['remaining'] <= self.rate_limit_buffer and \
-                   ratelimit['reset'] > time.time():
-                    if hasattr(self.api, 'last_response'):
-                        last_response = self.api.last_response
-                    else:
-                        last_response = None
-                    raise TwitterAPIPreRateLimited(
-                        'No quota left', last_response, ratelimit)
-
-            try:
-                result = attr(*args, **kwargs)
-            except TweepError, e:
-                self.update_rate_limits(name)
-                self.handle_error(e, name)
-            else:
-                self.update_rate_limits(name)
-
-            return result
+            if self.max_wait is None:
+                return self.call_endpoint(name, attr, *args, **kwargs)
+
+            deadline = time.time() + self.max_wait
+            while True:
+                try:
+                    return self.call_endpoint(name, attr, *args, **kwargs)
+                except TwitterAPIRateLimited, e:
+                    if e.retry_at is None or e.retry_at > deadline or \
+                       time.time() >= deadline:
+                        raise
+                    logging.debug('Waiting %.0fs for %s quota' % \
+                                  (e.retry_at - time.time(), name))
+                    # a second extra for clock differences
+                    time.sleep(max(e.retry_at - time.time(), 0) + 1)
 
         return func
 
+    def call_endpoint(self, name, attr, *args, **kwargs):
+        # FIXME: assumes we're doing an authenticated rate
+        # limited call
+        # some aren't (like unfollowing)
+        #logging.warning(name)
+        #logging.warning(self.rate_limits)
+
+        if self.rate_limit_store is not None:
+            allowed, ratelimit = self.rate_limit_store.acquire(
+                self.account_id, name, self.rate_limit_buffer)
+            if ratelimit:
+                self.rate_limits[name] = ratelimit
+            if not allowed:
+                self.pre_rate_limited(ratelimit)
+
+        elif name in self.rate_limits:
+            ratelimit = self.rate_limits[name]
+
+            # the twitter api is misreporting the rate limits of
+            # 'me' endpoint as 180 when it seems to be 15
+            if name == 'me' and ratelimit['remaining'] >= 165:
+                logging.debug('adjusting rate limit for the ' + \
+                              '"me" endpoint')
+                ratelimit['remaining'] -= 165
+
+            #print ratelimit['remaining']
+            #print ratelimit['reset']
+            #print time.time()
+
+            if ratelimit['remaining'] <= self.rate_limit_buffer and \
+               ratelimit['reset'] > time.time():
+                self.pre_rate_limited(ratelimit)
+
+        try:
+            result = attr(*args, **kwargs)
+        except TweepError, e:
+            self.update_rate_limits(name)
+            self.handle_error(e, name)
+        else:
+            self.update_rate_limits(name)
+
+        return result
+
+    def pre_rate_limited(self, ratelimit):
+        if hasattr(self.api, 'last_response'):
+            last_response = self.api.last_response
+        else:
+            last_response = None
+        raise TwitterAPIPreRateLimited(
+            'No quota left', last_response, ratelimit)
+
     def handle_error(self, e, name):
         if e.response:
             if e.response and e.response.status == 429:
@@ -143,25 +246,7 @@ class TweepyProxy(object):
             for i, user in enumerate(users):
                 users[i] = cls.trim_users(user)
         else:
-            fields = set([
-                'name',
-                'location',
-                'profile_image_url',
-                'created_at',
-                'url',
-                'id',
-                'protected',
-                'followers_count',
-                'lang',
-                'verified',
-                'description',
-                'friends_count',
-                'statuses_count',
-                'screen_name',
-                'following',
-                'status',
-            ])
-            users = dict((key, users.get(key)) for key in fields)
+            users = dict((key, users.get(key)) for key in cls.USER_FIELDS)
 
         return users
 
@@ -172,39 +257,86 @@ class TweepyProxy(object):
     def ordered_lookup_users(self, ids):
         """Twitter's lookup_users endpoint may not return users in order, and may
         be missing some users, so use this instead. Currently doesn't accept
-        screen names, only numeric twitter ids.
+        screen names, only numeric twitter ids. Any number of ids can be
+        looked up (see LookupCoalescer).
+        """
+        if self.profile_cache is None:
+            users = self.lookup_coalescer.lookup(self, ids)
+            return [users.get(long(id)) or {'id': None} for id in ids]
+
+        keys = [long(id) for id in ids]
+        users = self.profile_cache.get_many(set(keys))
+        misses = [key for key in set(keys) if not key in users]
+
+        if misses:
+            fetched = self.lookup_coalescer.lookup(self, misses)
+            fetched = dict((key, self.trim_users(user) if user else None) \
+                           for key, user in fetched.iteritems())
+            # cached profiles don't have the viewer's following and status,
+            # neither do the ones just fetched so all are alike
+            users.update(self.profile_cache.set_many(fetched))
+
+        return [users.get(key) or {'id': None} for key in keys]
+
+    def iter_pages(self, relationship, state=None, **kwargs):
+        """Yields the ids of a relationship a page (up to 5000 ids) at a time.
+        The cursor in state is advanced as pages are fetched.
         """
-        id_key = 'id' if ids and isinstance(ids[0], int) else 'id_str'
-        users = dict((user[id_key], user) for user in self.lookup_users(ids))
-        return [users.get(id, {'id': None}) for id in ids]
-
-    def fetch_all(self, relationship, state=None, **kwargs):
         method = getattr(self, '%s_ids' % relationship)
 
         if state is None:
-            state = {'ids': [], 'cursor': -1}
+            state = {'cursor': -1}
         else:
-            state.setdefault('ids', [])
             state.setdefault('cursor', -1)
 
         cursor = state['cursor']
 
         while not cursor == 0:
             result, (prev, cursor) = method(
-                cursor=cursor, stringify_ids=True, **kwargs)
-            state['ids'] += result['ids']
+                cursor=cursor, stringify_ids=not self.integer_ids, **kwargs)
             state['cursor'] = cursor
+            yield result['ids']
+
+    def fetch_all(self, relationship, state=None, **kwargs):
+        if state is None:
+            state = {'ids': [], 'cursor': -1}
+        else:
+            state.setdefault('ids', [])
+            state.setdefault('cursor', -1)
+
+        if self.integer_ids:
+            state['ids'] = id_array(int(id) for id in state['ids'])
+
+        for ids in self.iter_pages(relationship, state, **kwargs):
+            state['ids'].extend(ids)
 
         return state['ids']
 
+    def fetch_sorted(self, relationship, state=None, **kwargs):
+        """Like fetch_all but returns a sorted array of integer ids that is
+        built a page at a time instead of a list of strings. The unsorted
+        array is kept as the ids of state so the fetch can be resumed.
+        """
+        if state is None:
+            state = {'cursor': -1}
+
+        ids = state['ids'] = id_array(
+            int(id) for id in state.get('ids', ()))
+
+        for page in self.iter_pages(relationship, state, **kwargs):
+            ids.extend(int(id) for id in page)
+
+        return sort_id_array(ids)
+
     def async_fetch_relationships(self, followers=None,
-                                  friends=None, **kwargs):
+                                  friends=None, sort=False, **kwargs):
+        """Pass sort=True to get sorted arrays (see fetch_sorted).
+        """
         assert 'gevent' in globals(), 'gevent not detected'
 
-        g1 = gevent.spawn(self.fetch_all, 'followers',
-                          followers, **kwargs)
-        g2 = gevent.spawn(self.fetch_all, 'friends',
-                          friends, **kwargs)
+        fetch = self.fetch_sorted if sort else self.fetch_all
+        g1 = gevent.spawn(fetch, 'followers', followers, **kwargs)
+        g2 = gevent.spawn(fetch, 'friends', friends, **kwargs)
 
         gevent.joinall([g1, g2])
 
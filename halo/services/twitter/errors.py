@@ -27,6 +27,14 @@ class TwitterAPIRateLimited(TweepError):
         #remaining = self.response.getheader('x-rate-limit-remaining')
         #return int(remaining) if remaining is not None else remaining
 
+    @property
+    def retry_at(self):
+        """Unix time when the quota is reset (None if unknown), e.g. for a
+        task's eta.
+        """
+        reset = self.ratelimit_reset
+        return float(reset) if reset is not None else None
+
     @property
     def seconds_until_reset(self):
         # TODO: test this
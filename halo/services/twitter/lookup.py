@@ -0,0 +1,104 @@
+import threading
+from tweepy import TweepError
+
+try:
+    import gevent.pool
+except ImportError:
+    pass
+
+class LookupTimeout(Exception):
+    pass
+
+class Pending(object):
+    """A user being looked up by some caller"""
+    def __init__(self):
+        self.event = threading.Event()
+        self.user = None
+        self.exception = None
+
+    def set(self, user=None, exception=None):
+        self.user = user
+        self.exception = exception
+        self.event.set()
+
+    def get(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise LookupTimeout('Timed out waiting for a user lookup')
+        if self.exception is not None:
+            raise self.exception
+        return self.user
+
+class LookupCoalescer(object):
+    """Looks up users 100 ids (the most users/lookup accepts) at a time,
+    concurrently when gevent is installed. Ids already being looked up by
+    another caller in the process for the same account are waited for
+    (at most timeout seconds) instead of requested again. Lookups aren't
+    shared between accounts, 'following' and 'status' depend on who asks.
+    """
+    CHUNK_SIZE = 100
+
+    def __init__(self, concurrency=4, timeout=120):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def lookup(self, api, ids):
+        """Returns {id (as a long): user or None if there isn't one}. api is
+        a TweepyProxy so rate limits are checked for every request.
+        """
+        keys = set(long(id) for id in ids)
+        account_id = api.account_id
+        waits = {}
+        mine = []
+
+        with self.lock:
+            for key in keys:
+                pending = self.pending.get((account_id, key))
+                if pending is None:
+                    pending = self.pending[(account_id, key)] = Pending()
+                    mine.append(key)
+                waits[key] = pending
+
+        chunks = [mine[i:i+self.CHUNK_SIZE] \
+                  for i in xrange(0, len(mine), self.CHUNK_SIZE)]
+
+        if len(chunks) > 1 and 'gevent' in globals():
+            pool = gevent.pool.Pool(self.concurrency)
+            for chunk in chunks:
+                pool.spawn(self.fetch, api, chunk, waits)
+            pool.join()
+        else:
+            for chunk in chunks:
+                self.fetch(api, chunk, waits)
+
+        return dict((key, pending.get(self.timeout)) \
+                    for key, pending in waits.iteritems())
+
+    def fetch(self, api, chunk, waits):
+        try:
+            try:
+                users = api.lookup_users(chunk)
+            except TweepError, e:
+                # twitter responds with a 404 if none of the users exist
+                if e.response is not None and e.response.status == 404:
+                    users = []
+                else:
+                    raise
+        except Exception, e:
+            for key in chunk:
+                waits[key].set(exception=e)
+        else:
+            found = dict((long(user['id']), user) for user in users)
+            for key in chunk:
+                waits[key].set(found.get(key))
+        finally:
+            # interrupted (gevent.Timeout, GreenletExit, KeyboardInterrupt),
+            # don't leave the other callers waiting
+            for key in chunk:
+                if not waits[key].event.is_set():
+                    waits[key].set(exception=LookupTimeout(
+                        'The lookup of this user was interrupted'))
+            with self.lock:
+                for key in chunk:
+                    self.pending.pop((api.account_id, key), None)
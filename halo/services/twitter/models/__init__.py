@@ -2,3 +2,6 @@ from relationships import *
 from relationshipstats import *
 from history import *
 from notifications import *
+from relationshipedges import *
+from historyarchive import *
+from profiles import *
@@ -1,7 +1,13 @@
-from relationships import Relationships
-from relationshipstats import RelationshipStats
+from relationships import Relationships, FetchCheckpoints
+from relationshipstats import RelationshipStats, RelationshipStatsRollups
 from history import History
+from relationshipedges import RelationshipEdges
+from profiles import CachedProfiles
 
 Relationships.create_table(fail_silently=True)
 RelationshipStats.create_table(fail_silently=True)
 History.create_table(fail_silently=True)
+RelationshipEdges.create_table(fail_silently=True)
+FetchCheckpoints.create_table(fail_silently=True)
+RelationshipStatsRollups.create_table(fail_silently=True)
+CachedProfiles.create_table(fail_silently=True)
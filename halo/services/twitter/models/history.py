@@ -2,13 +2,17 @@ import logging
 from datetime import datetime
 from functools import partial
 from peewee import *
+from halo.peewee_ext import bulk_insert
 from app import db
 
 class History(db.Model):
+    # max rows per insert statement
+    FLUSH_SIZE = 500
+
     created = DateTimeField(default=datetime.now)
 
     # twitter account ids
-    user1 = BigIntegerField(index=True)
+    user1 = BigIntegerField()
     user2 = BigIntegerField()
 
     relationship_2to1 = CharField(choices=[
@@ -22,8 +26,74 @@ class History(db.Model):
         return cls.select().where((cls.user1 == user1) & (cls.id > start_id))\
                 .order_by(cls.id.desc()).limit(limit)
 
+    @classmethod
+    def _filter(cls, query, relationship=None, since=None, until=None):
+        if relationship:
+            query = query.where(cls.relationship_2to1 == relationship)
+        if since:
+            query = query.where(cls.created >= since)
+        if until:
+            query = query.where(cls.created < until)
+        return query
+
+    @classmethod
+    def timeline(cls, user1, before_id=None, after_id=None, limit=20,
+                 relationship=None, since=None, until=None):
+        """Keyset pagination, newest first. Pass the id of the last item as
+        before_id for the next (older) page, or the id of the first item as
+        after_id for newer items (the oldest limit of them), not both.
+        """
+        if after_id is not None and before_id is not None:
+            raise ValueError('Pass either before_id or after_id, not both')
+
+        query = cls._filter(cls.select().where(cls.user1 == user1),
+                            relationship, since, until)
+
+        if after_id is not None:
+            query = query.where(cls.id > after_id).order_by(cls.id.asc())
+            return list(query.limit(limit))[::-1]
+
+        if before_id is not None:
+            query = query.where(cls.id < before_id)
+
+        return list(query.order_by(cls.id.desc()).limit(limit))
+
+    @classmethod
+    def counts_per_day(cls, user1, relationship=None, since=None,
+                       until=None, utc_offset=0):
+        """Returns a list of (date, count) ordered by date. Dates are local
+        to utc_offset (seconds) like DailyCounts, since and until are UTC.
+        """
+        day = fn.DATE(cls.created)
+        if utc_offset:
+            day = fn.DATE(fn.DATE_ADD(
+                cls.created, SQL('INTERVAL %s SECOND', int(utc_offset))))
+        query = cls.select(day.alias('day'), fn.COUNT(cls.id).alias('count'))\
+                .where(cls.user1 == user1)
+        query = cls._filter(query, relationship, since, until)
+        return list(query.group_by(day).order_by(day).tuples())
+
     class Meta:
         db_table = 'twitter_history'
+        indexes = (
+            (('user1', 'id'), False),
+        )
+
+    @classmethod
+    def migrate_timeline_index(cls):
+        """Add the (user1, id) index to an existing table, create_table only
+        adds it to new ones. Does nothing if the table already has it.
+        """
+        table = cls._meta.db_table
+        name = '%s_user1_id' % table
+        cursor = db.database.execute_sql(
+            'SHOW INDEX FROM %s WHERE Key_name=%%s' % table, (name,))
+        if cursor.fetchone():
+            return False
+
+        db.database.execute_sql(
+            'ALTER TABLE %s ADD INDEX %s (user1, id)' % (table, name))
+        return True
 
     #
     # LOOM
@@ -31,14 +101,20 @@ class History(db.Model):
 
     @classmethod
     def set_loom(cls, loom, account_id):
-        loom.bind('unfollowers', partial(cls.refresh, account_id))
+        """Unfollowers are batched and inserted when the loom finishes, or
+        once FLUSH_SIZE of them have been emitted. Use a loom with a
+        transaction to insert them in the same transaction as the
+        Relationships save, they're then all inserted when it finishes
+        (FLUSH_SIZE rows per statement).
+        """
+        size = True if getattr(loom, 'transaction', None) else cls.FLUSH_SIZE
+        loom.bind('unfollowers', partial(cls.refresh, account_id), batch=size)
 
     @classmethod
     def refresh(cls, account_id, ids, relationship):
-        # TODO: bulk insert
-        for unfollower in ids:
-            cls.insert(
-                user1=account_id,
-                user2=unfollower,
-                relationship_2to1=relationship).execute()
-
+        now = datetime.now()
+        bulk_insert(cls, (dict(created=now,
+                               user1=account_id,
+                               user2=unfollower,
+                               relationship_2to1=relationship) \
+                          for unfollower in ids), max_rows=cls.FLUSH_SIZE)
@@ -0,0 +1,151 @@
+import os, gzip, json, logging
+from datetime import datetime
+from peewee import fn
+from history import History
+
+"""
+Retention for twitter_history. Rows older than the retention period are
+exported a month at a time to append-only gzip'd JSON lines files (one per
+month, e.g. twitter_history-2014-01.jsonl.gz) and deleted from the table, so
+the live table and its index only hold recent months.
+
+Rows are written before they're deleted, so an interrupted archive may leave
+duplicates in a file which the reader ignores.
+"""
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def _month_start(when, months=0):
+    """First moment of the month that is months after when's month"""
+    month = when.year * 12 + when.month - 1 + months
+    return datetime(month // 12, month % 12 + 1, 1)
+
+class HistoryArchive(object):
+    def __init__(self, path, retention_months=6, batch_size=5000):
+        self.path = path
+        self.retention_months = retention_months
+        self.batch_size = batch_size
+
+    def filename(self, month):
+        return os.path.join(self.path, 'twitter_history-%s.jsonl.gz' % \
+                            month.strftime('%Y-%m'))
+
+    def months(self):
+        """Archived months, newest first"""
+        months = []
+        if not os.path.isdir(self.path):
+            return months
+
+        for name in os.listdir(self.path):
+            if name.startswith('twitter_history-') and \
+               name.endswith('.jsonl.gz'):
+                months.append(datetime.strptime(name[16:23], '%Y-%m'))
+        return sorted(months, reverse=True)
+
+    #
+    # WRITING
+    #
+
+    def archive(self, now=None):
+        """Archive and delete every month that has expired. Returns the
+        number of rows archived.
+        """
+        cutoff = _month_start(now or datetime.now(), -self.retention_months)
+        oldest = History.select(fn.MIN(History.created)).scalar(convert=True)
+        count = 0
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        while oldest is not None and oldest < cutoff:
+            month = _month_start(oldest)
+            count += self.archive_month(month)
+            oldest = History.select(fn.MIN(History.created)).scalar(convert=True)
+
+        return count
+
+    def archive_month(self, month):
+        end = _month_start(month, 1)
+        last_id = 0
+        count = 0
+
+        logging.info('Archiving history for %s' % month.strftime('%Y-%m'))
+
+        while True:
+            # a new query each time, select queries cache their results
+            rows = list(History.select().where(
+                (History.created >= month) & (History.created < end) & \
+                (History.id > last_id))\
+                    .order_by(History.id).limit(self.batch_size))
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            # gzip files can be appended to (each append is a new member)
+            with gzip.open(self.filename(month), 'ab') as f:
+                for row in rows:
+                    f.write(json.dumps({
+                        'id': row.id,
+                        'created': row.created.strftime(DATE_FORMAT),
+                        'user1': row.user1,
+                        'user2': row.user2,
+                        'relationship_2to1': row.relationship_2to1,
+                    }, separators=(',', ':')) + '\n')
+
+            History.delete().where(
+                History.id << [row.id for row in rows]).execute()
+            count += len(rows)
+
+        duplicates = self.check_month(month) if count else 0
+        if duplicates:
+            logging.warning('%s rows archived more than once for %s' % \
+                            (duplicates, month.strftime('%Y-%m')))
+
+        return count
+
+    def check_month(self, month):
+        """Returns the number of rows that are in the month's file more
+        than once (0 unless an archive was interrupted).
+        """
+        ids = set()
+        lines = 0
+        with gzip.open(self.filename(month), 'rb') as f:
+            for line in f:
+                ids.add(json.loads(line)['id'])
+                lines += 1
+        return lines - len(ids)
+
+    #
+    # READING
+    #
+
+    def iter_month(self, month, user1=None):
+        seen = set()
+        with gzip.open(self.filename(month), 'rb') as f:
+            for line in f:
+                row = json.loads(line)
+                if user1 is not None and not row['user1'] == user1:
+                    continue
+                if row['id'] in seen:
+                    continue
+                seen.add(row['id'])
+                row['created'] = datetime.strptime(row['created'],
+                                                   DATE_FORMAT)
+                yield History(**row)
+
+    def items(self, user1, start_id=-1, limit=20):
+        """Same as History.items but for archived rows. Returns a list of
+        (unsaved) History instances.
+        """
+        user1 = int(user1)
+        results = []
+
+        for month in self.months():
+            rows = [row for row in self.iter_month(month, user1) \
+                    if row.id > start_id]
+            results.extend(sorted(rows, key=lambda row: row.id,
+                                  reverse=True))
+            if len(results) >= limit:
+                break
+
+        return results[:limit]
@@ -7,7 +7,7 @@ class UnfollowNotifications(object):
         self.send_function = send_function
 
     def set_loom(self, loom, account, users, api):
-        loom.bind('unfollowers', self.refresh)
+        loom.bind('unfollowers', self.refresh, batch=True)
         loom.finish(partial(self.send, account, users, api))
         self.loom = loom
         return self
@@ -44,13 +44,14 @@ class UnfollowNotifications(object):
 
         # TODO: handle errors (put this in celery task)
         try:
-            unfollowers = api.lookup_users(self.ids)
+            unfollowers = [user for user in api.ordered_lookup_users(self.ids) \
+                           if user['id'] is not None]
         except:
             unfollowers = self.ids
             summary = None
         else:
             names = [unfollower['name'] for unfollower in unfollowers]
-            summary = self.summarize_names(names)
+            summary = self.summarize_names(names) if names else None
 
         name = account.profile['name']
 
@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+from peewee import *
+from halo.peewee_ext import JSONTextField, bulk_insert_update
+from app import db
+
+class CachedProfiles(db.Model):
+    """Shared tier of ProfileCache. profile (without the viewer dependent
+    fields) is null for users that don't exist (or are suspended).
+    """
+    # the twitter user id
+    id = BigIntegerField(primary_key=True)
+    profile = JSONTextField(null=True)
+    updated = DateTimeField(default=datetime.now, index=True)
+
+    class Meta:
+        db_table = 'twitter_cached_profiles'
+
+    @classmethod
+    def get_many(cls, ids, ttl, negative_ttl):
+        """Returns {id: profile or None} of the fresh rows"""
+        now = datetime.now()
+        results = {}
+        query = cls.select().where(
+            (cls.id << list(ids)) & \
+            (cls.updated > now - timedelta(seconds=max(ttl, negative_ttl))))
+
+        for row in query:
+            max_age = ttl if row.profile else negative_ttl
+            if row.updated > now - timedelta(seconds=max_age):
+                results[row.id] = row.profile
+
+        return results
+
+    @classmethod
+    def set_many(cls, profiles):
+        now = datetime.now()
+        bulk_insert_update(cls, (dict(id=id, profile=profile, updated=now) \
+                                 for id, profile in profiles.iteritems()))
+
+    @classmethod
+    def purge(cls, before):
+        return cls.delete().where(cls.updated < before).execute()
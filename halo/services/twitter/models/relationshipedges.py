@@ -0,0 +1,316 @@
+import logging
+from peewee import *
+from halo.peewee_ext import bulk_insert
+from relationships import Relationships
+from app import db
+
+class RelationshipEdges(db.Model):
+    """One row per id in a relationship list. Lists are ordered by position
+    (ascending), positions are spaced STEP apart so ids can be prepended or
+    moved without renumbering the rest of the list.
+    """
+    STEP = 1 << 16
+    DELETE_CHUNK = 1000
+
+    # the twitter account id
+    account_id = BigIntegerField()
+    other_id = BigIntegerField()
+    relationship = CharField(max_length=10)
+    position = BigIntegerField()
+
+    class Meta:
+        db_table = 'twitter_relationship_edges'
+        indexes = (
+            # page reads
+            (('account_id', 'relationship', 'position'), False),
+            # membership (an id only ever has one relationship)
+            (('account_id', 'other_id'), True),
+        )
+
+    @classmethod
+    def list_query(cls, account_id, relationship):
+        return cls.select(cls.other_id, cls.position).where(
+            (cls.account_id == account_id) & \
+            (cls.relationship == relationship)).order_by(cls.position)
+
+    @classmethod
+    def ids(cls, account_id, relationship, start=0, end=None):
+        if end is not None and end <= start:
+            # limit(0) is ignored by peewee
+            return []
+        query = cls.list_query(account_id, relationship)
+        if end is not None:
+            query = query.limit(end - start)
+        if start:
+            query = query.offset(start)
+        return [row.other_id for row in query]
+
+    @classmethod
+    def get_relationship(cls, account_id, other_id):
+        try:
+            return cls.select(cls.relationship).where(
+                (cls.account_id == account_id) & \
+                (cls.other_id == other_id)).get().relationship
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def first_position(cls, account_id, relationship):
+        position = cls.select(fn.MIN(cls.position)).where(
+            (cls.account_id == account_id) & \
+            (cls.relationship == relationship)).scalar()
+        return position if position is not None else 0
+
+    @classmethod
+    def remove(cls, account_id, ids):
+        ids = list(ids)
+        deleted = 0
+        for i in xrange(0, len(ids), cls.DELETE_CHUNK):
+            deleted += cls.delete().where(
+                (cls.account_id == account_id) & \
+                (cls.other_id << ids[i:i+cls.DELETE_CHUNK])).execute()
+        return deleted
+
+    @classmethod
+    def add(cls, account_id, relationship, ids, first_position):
+        """Insert ids so that the last one is positioned right before
+        first_position.
+        """
+        n = len(ids)
+        bulk_insert(cls, (dict(account_id=account_id,
+                               other_id=int(id),
+                               relationship=relationship,
+                               position=first_position - (n - i) * cls.STEP) \
+                          for i, id in enumerate(ids)))
+
+    @classmethod
+    def renumber(cls, account_id, relationship):
+        logging.debug('Renumbering %s edges of %s' % \
+                      (relationship, account_id))
+        query = cls.list_query(account_id, relationship)
+        ids = [row.other_id for row in query]
+        cls.remove(account_id, ids)
+        cls.add(account_id, relationship, ids, len(ids) * cls.STEP)
+
+    @classmethod
+    def move(cls, account_id, relationship, other_id, position):
+        """Move other_id to index position of the relationship list.
+        Returns False if other_id is not in the list.
+        """
+        query = cls.list_query(account_id, relationship).where(
+            cls.other_id != other_id)
+
+        for i in range(2):
+            if position > 0:
+                neighbors = list(query.offset(position - 1).limit(2)) or \
+                        list(query.order_by(cls.position.desc()).limit(1))
+            else:
+                neighbors = [None] + list(query.limit(1))
+
+            before = neighbors[0].position if neighbors and neighbors[0] \
+                    else None
+            after = neighbors[1].position if len(neighbors) > 1 else None
+
+            if before is None:
+                new_position = (after if after is not None else 0) - cls.STEP
+            elif after is None:
+                new_position = before + cls.STEP
+            elif after - before > 1:
+                new_position = (before + after) // 2
+            else:
+                # no gap left between neighbors
+                cls.renumber(account_id, relationship)
+                continue
+            break
+
+        return cls.update(position=new_position).where(
+            (cls.account_id == account_id) & \
+            (cls.relationship == relationship) & \
+            (cls.other_id == other_id)).execute() > 0
+
+    @classmethod
+    def store(cls, changes):
+        """Persist changes, a list of (account_id, relationship, old_ids,
+        ids). If ids is old_ids with new ids prepended and some removed (what
+        Relationships.refresh produces) then only the difference is written,
+        otherwise the whole list is rewritten. Run inside a transaction.
+        """
+        removals = []
+        additions = []
+
+        for account_id, relationship, old_ids, ids in changes:
+            old_set = set(old_ids)
+            new = [id for id in ids if not id in old_set]
+            ids_set = set(ids)
+            kept = [id for id in old_ids if id in ids_set]
+
+            if ids[:len(new)] == new and ids[len(new):] == kept:
+                removals.append((account_id, old_set - ids_set))
+                first = cls.first_position(account_id, relationship) \
+                        if kept else 0
+                additions.append((account_id, relationship, new, first))
+            else:
+                removals.append((account_id, old_set))
+                additions.append(
+                    (account_id, relationship, ids, len(ids) * cls.STEP))
+
+        # remove first since an id may be moving between relationships
+        for account_id, ids in removals:
+            if ids:
+                cls.remove(account_id, ids)
+        for account_id, relationship, ids, first in additions:
+            if ids:
+                cls.add(account_id, relationship, ids, first)
+
+class EdgeRelationships(Relationships):
+    """Relationships that keeps its id lists in RelationshipEdges instead of
+    the slackers, buddies, and fans columns (which are left empty). Lists are
+    loaded on first access and written on save.
+    """
+    RELATIONSHIPS = ('slackers', 'buddies', 'fans')
+
+    class Meta:
+        db_table = 'twitter_relationships'
+
+    def __init__(self, *args, **kwargs):
+        super(EdgeRelationships, self).__init__(*args, **kwargs)
+        self._edge_ids = {}
+        self._edge_old_ids = {}
+
+    def relationship_ids(self, rel, ids=None):
+        if not ids is None:
+            if not rel in self._edge_old_ids:
+                self._edge_old_ids[rel] = self.relationship_ids(rel)
+            self._edge_ids[rel] = list(ids)
+            setattr(self, '%s_count' % rel, len(ids))
+        else:
+            if not rel in self._edge_ids:
+                self._edge_ids[rel] = self.get_ids(self.id, rel, 0, None)
+            return self._edge_ids[rel]
+
+    def change_relationship(self, user_id, old_rel, new_rel):
+        user_id = self.convert_id(user_id)
+
+        with db.database.transaction():
+            self._lock(self.id)
+            if old_rel:
+                RelationshipEdges.remove(self.id, [user_id])
+            if new_rel:
+                RelationshipEdges.add(self.id, new_rel, [user_id], \
+                        RelationshipEdges.first_position(self.id, new_rel))
+
+        if old_rel:
+            self._edge_ids.pop(old_rel, None)
+            setattr(self, '%s_new_index' % old_rel, 0)
+            setattr(self, '%s_count' % old_rel, \
+                    getattr(self, '%s_count' % old_rel)-1)
+
+        if new_rel:
+            self._edge_ids.pop(new_rel, None)
+            setattr(self, '%s_new_index' % new_rel, 0)
+            setattr(self, '%s_count' % new_rel, \
+                    getattr(self, '%s_count' % new_rel)+1)
+
+    def save(self, *args, **kwargs):
+        changes = [(self.id, rel, self._edge_old_ids[rel], ids) \
+                   for rel, ids in self._edge_ids.iteritems() \
+                   if rel in self._edge_old_ids]
+
+        with db.database.transaction():
+            result = super(EdgeRelationships, self).save(*args, **kwargs)
+            if changes:
+                RelationshipEdges.store(changes)
+
+        self._edge_old_ids.clear()
+        return result
+
+    def to_json(self, rpp=-1):
+        result = super(EdgeRelationships, self).to_json(rpp=None)
+
+        if rpp is not None:
+            for rel in self.RELATIONSHIPS:
+                if rel in self._edge_ids:
+                    ids = self._edge_ids[rel][:None if rpp == -1 else rpp]
+                else:
+                    ids = self.get_ids(self.id, rel, 0, \
+                            None if rpp == -1 else rpp)
+                result[rel] = [str(id) for id in ids]
+
+        return result
+
+    @classmethod
+    def _lock(cls, pk):
+        """Lock the account's row until the transaction ends, so edge
+        positions (first_position) aren't read by concurrent updates
+        before they're written. Like Relationships._update_packed.
+        """
+        cls.select(cls.id).where(cls.id == pk).for_update().execute()
+
+    @classmethod
+    def _update_counts(cls, pk, relationship, delta):
+        table = cls._meta.db_table
+        q = ('UPDATE %s SET %s_count=%s_count+%%s, %s_new_index=0 ' + \
+             'WHERE id=%%s') % \
+                (table, relationship, relationship, relationship)
+        db.database.execute_sql(q, (delta, pk))
+
+    @classmethod
+    def remove_id(cls, pk, relationship, id):
+        id = int(id)
+        with db.database.transaction():
+            deleted = RelationshipEdges.delete().where(
+                (RelationshipEdges.account_id == pk) & \
+                (RelationshipEdges.other_id == id) & \
+                (RelationshipEdges.relationship == relationship)).execute()
+            if deleted:
+                cls._update_counts(pk, relationship, -deleted)
+
+    @classmethod
+    def prepend_id(cls, pk, relationship, id):
+        id = int(id)
+        with db.database.transaction():
+            cls._lock(pk)
+            RelationshipEdges.add(pk, relationship, [id], \
+                    RelationshipEdges.first_position(pk, relationship))
+            cls._update_counts(pk, relationship, 1)
+
+    @classmethod
+    def move_id(cls, pk, relationship, id, position):
+        """Moves id to a different location.
+        """
+        id = int(id)
+        assert isinstance(position, int)
+
+        with db.database.transaction():
+            if RelationshipEdges.move(pk, relationship, id, position):
+                # reset new index (would be hard to track new ids when moved)
+                cls._update_counts(pk, relationship, 0)
+
+    @classmethod
+    def get_ids(cls, id, relationship, start, end):
+        ids = RelationshipEdges.ids(int(id), relationship, start, end)
+        return ids if cls.integer_ids else [str(other_id) for other_id in ids]
+
+    @classmethod
+    def get_relationship(cls, pk, id):
+        return RelationshipEdges.get_relationship(pk, int(id))
+
+    @classmethod
+    def migrate_from_columns(cls, query=None):
+        """Copy id lists from the relationship columns into the edge table.
+        Accounts that already have edges are skipped, so it can be run
+        again after an interruption. Returns the number of accounts copied.
+        """
+        query = query or Relationships.select()
+        count = 0
+        for row in query:
+            changes = [(row.id, rel, [], row.relationship_ids(rel) or []) \
+                       for rel in cls.RELATIONSHIPS]
+            with db.database.transaction():
+                cls._lock(row.id)
+                if RelationshipEdges.select(RelationshipEdges.id).where(
+                        RelationshipEdges.account_id == row.id).exists():
+                    continue
+                RelationshipEdges.store(changes)
+                count += 1
+        return count
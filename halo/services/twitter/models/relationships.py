@@ -1,9 +1,10 @@
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from peewee import *
-from oset import oset
-from halo.peewee_ext import JSONField, TimestampUpdatedField
+from halo.peewee_ext import JSONField, TimestampUpdatedField, insert_update
 from halo.loom import Weave
+from halo.util.ids import PackedIds, pack_ids, id_array, sorted_id_array, \
+        sorted_contains, sorted_difference, sorted_intersection, ordered_merge
 from app import db
 
 #
@@ -17,17 +18,112 @@ class UserIdsField(TextField):
     NOTE: cant use "like" on TEXT types?
     """
     def db_value(self, value):
-        return ',' + ','.join(value) + ',' if value else ''
+        return ',' + ','.join(map(str, value)) + ',' if value else ''
 
     def python_value(self, value):
         value = value.split(',')[1:-1] if value else []
+        if getattr(self.model_class, 'integer_ids', False):
+            value = [int(id) for id in value]
         return value
 
+class PackedUserIdsField(BlobField):
+    """Stores ids as a delta encoded varint byte string (see halo.util.ids)
+    in a LONGBLOB. Values are returned as a lazily decoded PackedIds. Rows
+    still in the comma separated UserIdsField format are read transparently
+    and rewritten packed on the next save (see migrate_packed_ids). Ids are
+    decoded as strings unless string_ids is False or the model has
+    integer_ids set.
+    """
+    db_field = 'longblob'
+
+    def __init__(self, string_ids=None, *args, **kwargs):
+        self.string_ids = string_ids
+        super(PackedUserIdsField, self).__init__(*args, **kwargs)
+
+    def db_value(self, value):
+        if not value:
+            return ''
+        if isinstance(value, PackedIds):
+            value = value.packed()
+        else:
+            value = pack_ids(value)
+        return super(PackedUserIdsField, self).db_value(value)
+
+    def python_value(self, value):
+        if not value:
+            return []
+
+        value = str(value)
+        string_ids = self.string_ids
+        if string_ids is None:
+            string_ids = not getattr(self.model_class, 'integer_ids', False)
+        convert = str if string_ids else None
+
+        if value.startswith(','):
+            # legacy UserIdsField format
+            ids = value.split(',')[1:-1]
+            return ids if string_ids else [int(id) for id in ids]
+
+        return PackedIds(value, convert)
+
 #
 # MODELS
 #
 
+class FetchCheckpoints(db.Model):
+    """Progress of relationship fetches that were interrupted (e.g. by rate
+    limiting) so the next refresh can continue where it left off.
+    """
+    # discard checkpoints that are too old to be worth resuming
+    MAX_AGE = timedelta(days=7)
+
+    account_id = BigIntegerField()
+    relationship = CharField(max_length=10)
+    cursor = BigIntegerField()
+    ids = PackedUserIdsField(null=True)
+    updated = DateTimeField(default=datetime.now)
+
+    class Meta:
+        db_table = 'twitter_fetchcheckpoints'
+        primary_key = CompositeKey('account_id', 'relationship')
+
+    @classmethod
+    def state(cls, account_id, relationship):
+        """Returns a state dict for TweepyProxy.fetch_all, resumed from the
+        checkpoint if there is one.
+        """
+        try:
+            row = cls.get((cls.account_id == account_id) & \
+                          (cls.relationship == relationship))
+        except cls.DoesNotExist:
+            return {'cursor': -1, 'ids': []}
+
+        if row.updated < datetime.now() - cls.MAX_AGE:
+            return {'cursor': -1, 'ids': []}
+
+        logging.debug('Resuming %s fetch of %s at cursor %s (%s ids)' % \
+                      (relationship, account_id, row.cursor, len(row.ids)))
+        return {'cursor': row.cursor, 'ids': list(row.ids)}
+
+    @classmethod
+    def save_state(cls, account_id, relationship, state):
+        if state.get('cursor', -1) == -1:
+            return
+        insert_update(cls,
+                      account_id=account_id,
+                      relationship=relationship,
+                      cursor=state['cursor'],
+                      ids=state.get('ids'),
+                      updated=datetime.now())
+
+    @classmethod
+    def clear(cls, account_id):
+        cls.delete().where(cls.account_id == account_id).execute()
+
 class Relationships(Weave, db.Model):
+    # keep ids as ints (in arrays after a refresh) instead of strings
+    integer_ids = False
+
     # the twitter account id
     #id = PrimaryKeyField()
     id = BigIntegerField(primary_key=True)
@@ -35,9 +131,9 @@ class Relationships(Weave, db.Model):
     #created = DateTimeField(default=datetime.now)
     updated = TimestampUpdatedField(null=True)
 
-    slackers = UserIdsField(null=True)
-    buddies = UserIdsField(null=True)
-    fans = UserIdsField(null=True)
+    slackers = PackedUserIdsField(null=True)
+    buddies = PackedUserIdsField(null=True)
+    fans = PackedUserIdsField(null=True)
 
     slackers_count = IntegerField(null=True)
     buddies_count = IntegerField(null=True)
@@ -85,17 +181,58 @@ class Relationships(Weave, db.Model):
                 if rpp is None:
                     continue
                 if rpp == -1: rpp = None
-                result[field] = getattr(self, field)[:rpp]
+                ids = getattr(self, field)[:rpp]
+                if self.integer_ids:
+                    # 64 bit ints aren't safe for javascript clients
+                    ids = [str(id) for id in ids]
+                result[field] = ids
             else:
                 result[field] = getattr(self, field)
 
         return result
 
     @classmethod
-    def remove_id(cls, pk, relationship, id):
-        table = cls._meta.db_table
+    def convert_id(cls, id):
         id = str(id)
         assert id.isdigit()
+        return int(id) if cls.integer_ids else id
+
+    @classmethod
+    def is_packed(cls, relationship):
+        return isinstance(cls._meta.fields[relationship], PackedUserIdsField)
+
+    @classmethod
+    def _update_packed(cls, pk, relationship, func):
+        """Packed ids can't be edited with string functions in sql so do
+        the update in python, with the row locked so concurrent updates
+        aren't lost.
+        """
+        field = cls._meta.fields[relationship]
+        table = cls._meta.db_table
+        q = ("UPDATE %s SET %s=%%s, %s_count=%s_count+%%s, " + \
+                "%s_new_index=0 WHERE id=%%s") % \
+                (table, relationship, relationship, relationship, relationship)
+
+        with db.database.transaction():
+            row = cls.select(field).where(cls.id == pk).for_update().get()
+            ids = getattr(row, relationship)
+            delta = func(ids)
+            db.database.execute_sql(q, (field.db_value(ids), delta, pk))
+
+    @classmethod
+    def remove_id(cls, pk, relationship, id):
+        table = cls._meta.db_table
+        id = cls.convert_id(id)
+
+        if cls.is_packed(relationship):
+            def remove(ids):
+                try:
+                    ids.remove(id)
+                except ValueError:
+                    return 0
+                return -1
+            return cls._update_packed(pk, relationship, remove)
+
         # NOTE: there is no confirmation that id has been found and removed
         # set new_index to zero to simplify things
         q = ("UPDATE %s SET %s=REPLACE(%s,'%s,',''), " + \
@@ -107,8 +244,14 @@ class Relationships(Weave, db.Model):
     @classmethod
     def prepend_id(cls, pk, relationship, id):
         table = cls._meta.db_table
-        id = str(id)
-        assert id.isdigit()
+        id = cls.convert_id(id)
+
+        if cls.is_packed(relationship):
+            def prepend(ids):
+                ids.insert(0, id)
+                return 1
+            return cls._update_packed(pk, relationship, prepend)
+
         # NOTE: there is no confirmation row has been found and there are no
         # duplicates
         # set new_index to zero to simplify things
@@ -122,11 +265,10 @@ class Relationships(Weave, db.Model):
     def move_id(cls, pk, relationship, id, position):
         """Moves id to a different location.
         """
-        id = str(id)
-        assert id.isdigit()
+        id = cls.convert_id(id)
         assert isinstance(position, int)
 
-        row = Relationships.get(id=pk)
+        row = cls.get(id=pk)
         ids = getattr(row, relationship)
         ids.remove(id)
         ids.insert(position, id)
@@ -136,6 +278,8 @@ class Relationships(Weave, db.Model):
 
     def change_relationship(self, user_id, old_rel, new_rel):
         # TODO: may throw a ValueError if user_id not in list
+        user_id = self.convert_id(user_id)
+
         if old_rel:
             getattr(self, old_rel).remove(user_id)
             setattr(self, '%s_new_index' % old_rel, 0)
@@ -178,6 +322,13 @@ class Relationships(Weave, db.Model):
     def get_ids(cls, id, relationship, start, end):
         id = int(id)
         table = cls._meta.db_table
+
+        if cls.is_packed(relationship):
+            field = cls._meta.fields[relationship]
+            row = cls.select(field).where(cls.id == id).get()
+            # only decodes up to end
+            return getattr(row, relationship)[start:end]
+
         sql = \
         "SELECT SUBSTRING(SUBSTRING_INDEX(%s,',',%s+1), " \
         "LENGTH(SUBSTRING_INDEX(%s,',',%s+1))+2) FROM %s WHERE id=%%s" % \
@@ -190,11 +341,41 @@ class Relationships(Weave, db.Model):
         if ids and not ids[-1]:
             del ids[-1]
 
+        if cls.integer_ids:
+            ids = [int(id) for id in ids]
+
         return ids
 
     class Meta:
         db_table = 'twitter_relationships'
 
+    @classmethod
+    def migrate_packed_ids(cls, alter=True):
+        """Migrate relationship columns from UserIdsField to
+        PackedUserIdsField. Rows are read in either format so rewriting them
+        can also be left to the next refresh.
+        """
+        table = cls._meta.db_table
+        rels = [rel for rel in ('slackers', 'buddies', 'fans') \
+                if cls.is_packed(rel)]
+
+        if alter:
+            for rel in rels:
+                db.database.execute_sql(
+                    'ALTER TABLE %s MODIFY %s LONGBLOB NULL' % (table, rel))
+
+        for rel in rels:
+            field = cls._meta.fields[rel]
+            # updated=updated so the timestamp isn't changed
+            q = 'UPDATE %s SET %s=%%s, updated=updated WHERE id=%%s' % \
+                    (table, rel)
+            query = cls.select(cls.id, field).where(
+                fn.LEFT(field, 1) == ',')
+
+            for row in query:
+                db.database.execute_sql(
+                    q, (field.db_value(getattr(row, rel)), row.id))
+
     #
     # LOOM
     #
@@ -208,49 +389,106 @@ class Relationships(Weave, db.Model):
     def _ordered_merge(self, fresh_set, cached_list=None, new_index=0):
         """Returns list with new items prepended, and index of first old item.
         """
+        # ids, old_ids, new_index
+        return ordered_merge(fresh_set, cached_list, new_index)
+
+    def _sorted_merge(self, fresh, cached_list=None, new_index=0):
+        """Same as _ordered_merge but fresh is a sorted array of integer ids.
+        Returns old ids as a sorted array, and ids as an array if
+        integer_ids is set.
+        """
+        convert = id_array if self.integer_ids else \
+                lambda ids: [str(id) for id in ids]
+
         if cached_list == None:
-            return list(fresh_set), set(), 0
+            return convert(fresh), id_array(), 0
 
-        cached_set = set(cached_list)
-        if fresh_set == cached_set:
-            return cached_list, set(), new_index
+        cached = sorted_id_array([cached_list])
+        old_ids = id_array(sorted_difference(cached, fresh))
+        new = convert(sorted_difference(fresh, cached))
 
-        new_set = fresh_set - cached_set
-        old_set = cached_set - fresh_set
+        if not new and not old_ids:
+            return cached_list, old_ids, new_index
 
         if new_index:
-            # adjust new_index appropriately if any ids are removed from old
-            # new set
-            new_index = len(set(cached_list[:new_index]) - old_set)
+            new_index = sum(1 for id in cached_list[:new_index] \
+                            if sorted_contains(fresh, int(id)))
 
-        results = oset(cached_list) - old_set
+        results = [id for id in cached_list \
+                   if sorted_contains(fresh, int(id))]
+        if self.integer_ids:
+            results = id_array(results)
 
         # ids, old_ids, new_index
-        return list(new_set) + list(results), old_set, len(new_set) + new_index
+        return new + results, old_ids, len(new) + new_index
+
+    def fetch(self, api, streaming=False, checkpoint=False):
+        """With checkpoint the fetch is resumed from any progress saved by a
+        previous interrupted fetch, and progress is saved if this one is
+        interrupted. Without streaming the ids are strings, whether or not
+        api has integer_ids set.
+        """
+        states = dict((rel, FetchCheckpoints.state(self.id, rel) \
+                             if checkpoint else None) \
+                      for rel in ('followers', 'friends'))
+        try:
+            result = api.async_fetch_relationships(
+                followers=states['followers'], friends=states['friends'],
+                id=self.id, sort=streaming)
+        except Exception:
+            if checkpoint:
+                for rel, state in states.iteritems():
+                    FetchCheckpoints.save_state(self.id, rel, state)
+            raise
+
+        if checkpoint:
+            FetchCheckpoints.clear(self.id)
+
+        if not streaming and getattr(api, 'integer_ids', False):
+            # the ids have to be compared with the cached string ids
+            result = tuple([str(id) for id in ids] for ids in result)
+
+        return result
 
-    def refresh(self, api):
-        followers, friends = api.async_fetch_relationships(
-            id=self.id)
+    def refresh(self, api, streaming=False, checkpoint=False):
+        """With streaming the follower and friend ids are collected into
+        sorted arrays a page at a time and diffed by walking them, instead of
+        building sets of strings. The followers and friends events then get
+        the arrays as ids. Streaming is always used with integer_ids, and
+        then the unfollowers and unfriends events get arrays too. See fetch
+        for checkpoint.
+        """
+        streaming = streaming or self.integer_ids
+        followers, friends = self.fetch(api, streaming, checkpoint)
 
         self.emit('followers', ids=followers)
         self.emit('friends', ids=friends)
 
-        followers = set(followers)
-        friends = set(friends)
+        if streaming:
+            difference = lambda a, b: id_array(sorted_difference(a, b))
+            intersection = lambda a, b: id_array(sorted_intersection(a, b))
+            merge = self._sorted_merge
+        else:
+            followers = set(followers)
+            friends = set(friends)
+            difference = lambda a, b: a - b
+            intersection = lambda a, b: a & b
+            merge = self._ordered_merge
+
         last_update = self.updated
         self.updated = datetime.now()
 
         for rel in ('slackers', 'fans', 'buddies'):
             if rel == 'slackers':
-                ids = friends - followers
+                ids = difference(friends, followers)
             elif rel == 'fans':
-                ids = followers - friends
+                ids = difference(followers, friends)
             else:
-                ids = followers & friends
+                ids = intersection(followers, friends)
 
             #new_index = 0 if self.reset_new_index else self.new_index(rel)
 
-            ids, old_ids, new_index = self._ordered_merge(
+            ids, old_ids, new_index = merge(
                 ids, self.relationship_ids(rel), self.new_index(rel))
 
             # ids are not new if this is the first time fetching
@@ -269,14 +507,18 @@ class Relationships(Weave, db.Model):
             if self.loom:
                 if rel in ['buddies', 'fans']:
                     # emit any unfollowers
-                    unfollowers = old_ids - followers
+                    unfollowers = difference(old_ids, followers)
                     if unfollowers:
+                        if not self.integer_ids:
+                            unfollowers = [str(id) for id in unfollowers]
                         self.emit('unfollowers', ids=unfollowers, relationship=rel)
 
                 if rel in ['slackers', 'buddies']:
                     # emit any unfriends
-                    unfriends = old_ids - friends
+                    unfriends = difference(old_ids, friends)
                     if unfriends:
+                        if not self.integer_ids:
+                            unfriends = [str(id) for id in unfriends]
                         self.emit('unfriends', ids=unfriends, relationship=rel)
 
         return self
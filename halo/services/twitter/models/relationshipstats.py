@@ -1,22 +1,136 @@
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import partial
 from peewee import *
 from flask_peewee.serializer import Serializer
-from halo.peewee_ext import JSONField, TimestampUpdatedField
+from halo.peewee_ext import JSONField, TimestampUpdatedField, RingBufferField
 from halo.services.models import DailyCounts
 from app import db
 
+class RelationshipStatsRollups(db.Model):
+    """Weekly and monthly aggregates of RelationshipStats series, folded in as
+    days are dropped from the daily series. Days up to last_day have been
+    folded, folding them again (a retried or failed save, a rollover racing
+    a refresh) only adds the days after it.
+    """
+    PERIODS = ('week', 'month')
+    # longest range (in days) that series() returns weekly rollups for
+    MAX_WEEKLY_RANGE = 26 * 7
+
+    # the twitter account id
+    account_id = BigIntegerField()
+    metric = CharField(max_length=20)
+    period = CharField(max_length=5, choices=[
+        ('week', 'week'),
+        ('month', 'month'),
+    ])
+    # local date of the first day of the period
+    start = DateField()
+
+    # number of days with a value
+    days = IntegerField()
+    total = BigIntegerField()
+    low = IntegerField()
+    high = IntegerField()
+    last = IntegerField()
+    # first and last day folded in
+    first_day = DateField()
+    last_day = DateField()
+
+    class Meta:
+        db_table = 'twitter_relationshipstats_rollups'
+        indexes = (
+            (('account_id', 'metric', 'period', 'start'), True),
+        )
+
+    @classmethod
+    def period_start(cls, period, day):
+        if period == 'week':
+            return day - timedelta(days=day.weekday())
+        return day.replace(day=1)
+
+    @classmethod
+    def fold(cls, account_id, metric, first_day, values):
+        """Add daily values (first_day being the date of the first one) to
+        the rollups of their periods. Days up to a rollup's last_day are
+        skipped, the rollups are locked while they're read and updated.
+        """
+        days = [(first_day + timedelta(days=i), value) \
+                for i, value in enumerate(values) if value is not None]
+        if not days:
+            return
+
+        starts = set(cls.period_start(period, day) \
+                     for day, value in days for period in cls.PERIODS)
+
+        with db.database.transaction():
+            query = cls.select(cls.period, cls.start, cls.last_day).where(
+                (cls.account_id == account_id) & \
+                (cls.metric == metric) & \
+                (cls.start << list(starts))).for_update()
+            folded = dict(((row.period, row.start), row.last_day) \
+                          for row in query)
+
+            rollups = {}
+            for day, value in days:
+                for period in cls.PERIODS:
+                    key = (period, cls.period_start(period, day))
+                    if key in folded and day <= folded[key]:
+                        continue
+                    if not key in rollups:
+                        rollups[key] = [0, 0, value, value, value, day, day]
+                    rollup = rollups[key]
+                    rollup[0] += 1
+                    rollup[1] += value
+                    rollup[2] = min(rollup[2], value)
+                    rollup[3] = max(rollup[3], value)
+                    rollup[4] = value
+                    rollup[6] = day
+
+            if not rollups:
+                return
+
+            q = ('INSERT INTO %s (account_id, metric, period, start, ' + \
+                 'days, total, low, high, last, first_day, last_day) ' + \
+                 'VALUES %s ON DUPLICATE KEY UPDATE ' + \
+                 'days=days+VALUES(days), total=total+VALUES(total), ' + \
+                 'low=LEAST(low,VALUES(low)), ' + \
+                 'high=GREATEST(high,VALUES(high)), last=VALUES(last), ' + \
+                 'last_day=VALUES(last_day)') % (cls._meta.db_table, ','.join(
+                     ['(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)'] * len(rollups)))
+            params = []
+            for (period, start), rollup in sorted(rollups.iteritems()):
+                params.extend([account_id, metric, period, start] + rollup)
+
+            db.database.execute_sql(q, params)
+
+    @classmethod
+    def series(cls, account_id, metric, start, end, period=None):
+        """Rollups of a metric for the periods overlapping start and end
+        (dates), oldest first. Weekly rollups are used for ranges up to
+        MAX_WEEKLY_RANGE days unless period is passed.
+        """
+        if period is None:
+            period = 'week' if (end - start).days <= cls.MAX_WEEKLY_RANGE \
+                    else 'month'
+
+        return list(cls.select().where(
+            (cls.account_id == account_id) & \
+            (cls.metric == metric) & \
+            (cls.period == period) & \
+            (cls.start >= cls.period_start(period, start)) & \
+            (cls.start <= end)).order_by(cls.start))
+
 class RelationshipStats(DailyCounts):
     id = BigIntegerField(primary_key=True)
 
     MAX_LENGTH = 60 # keep stats up to 60 days
     # fields required for DailyCounts
-    followers = JSONField(max_length=800, default=[])
-    friends = JSONField(max_length=800, default=[])
+    followers = RingBufferField(capacity=MAX_LENGTH, default=[])
+    friends = RingBufferField(capacity=MAX_LENGTH, default=[])
     #unfollows = JSONField(max_length=500, default=[])
-    unfollowers = JSONField(max_length=800, default=[])
-    unfriends = JSONField(max_length=800, default=[])
+    unfollowers = RingBufferField(capacity=MAX_LENGTH, default=[])
+    unfriends = RingBufferField(capacity=MAX_LENGTH, default=[])
     followers_updated = DateTimeField()
     friends_updated = DateTimeField()
     #unfollows_updated = DateTimeField()
@@ -26,6 +140,9 @@ class RelationshipStats(DailyCounts):
     class Meta:
         db_table = 'twitter_relationshipstats'
 
+    def expire_values(self, field_name, first_day, values):
+        RelationshipStatsRollups.fold(self.id, field_name, first_day, values)
+
     #
     # LOOM
     #
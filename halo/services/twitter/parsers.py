@@ -0,0 +1,159 @@
+import json
+from tweepy import TweepError
+from tweepy.parsers import JSONParser
+
+try:
+    import ujson
+except ImportError:
+    pass
+
+try:
+    import simplejson
+except ImportError:
+    pass
+
+class ProjectionParser(JSONParser):
+    """JSONParser that only keeps the whitelisted fields of user objects in
+    user payloads (e.g. lookup_users). The id is always kept.
+
+    User objects are projected as they're decoded (simplejson or json with
+    an object_pairs_hook), so the dicts built for them only hold the
+    whitelisted fields. Decoding hooks are called for nested objects too,
+    so a whitelist with fields that hold objects (NESTED_FIELDS, e.g. a
+    status with its user_mentions) is applied after decoding (with ujson
+    when it's installed) to only project the payload's users.
+    """
+    NESTED_FIELDS = frozenset(['status', 'entities'])
+
+    def __init__(self, fields, payload_types=('user',)):
+        JSONParser.__init__(self)
+        self.fields = frozenset(fields) | frozenset(['id'])
+        self.payload_types = payload_types
+
+        if self.fields & self.NESTED_FIELDS:
+            if 'ujson' in globals():
+                loads = ujson.loads
+            elif 'simplejson' in globals():
+                loads = simplejson.loads
+            else:
+                loads = json.loads
+            self.decode = lambda payload: self.project(loads(payload))
+        else:
+            lib = simplejson if 'simplejson' in globals() else json
+            self.decode = lib.JSONDecoder(
+                object_pairs_hook=self.project_pairs).decode
+
+    def project_pairs(self, pairs):
+        fields = self.fields
+        for key, value in pairs:
+            if key == 'screen_name':
+                return dict((key, value) for key, value in pairs \
+                            if key in fields)
+        return dict(pairs)
+
+    def project_user(self, user):
+        if isinstance(user, dict):
+            return dict((key, value) for key, value in user.iteritems() \
+                        if key in self.fields)
+        return user
+
+    def project(self, result):
+        """Projects a user, a list of users or the users of a cursored
+        response.
+        """
+        if isinstance(result, list):
+            return [self.project_user(user) for user in result]
+        if isinstance(result, dict):
+            if isinstance(result.get('users'), list):
+                result['users'] = self.project(result['users'])
+            elif 'screen_name' in result:
+                return self.project_user(result)
+        return result
+
+    def parse(self, method, payload):
+        if not method.payload_type in self.payload_types:
+            return JSONParser.parse(self, method, payload)
+
+        try:
+            result = self.decode(payload)
+        except Exception, e:
+            raise TweepError('Failed to parse JSON payload: %s' % e)
+
+        # like JSONParser
+        if 'cursor' in method.parameters and isinstance(result, dict) and \
+           'previous_cursor' in result and 'next_cursor' in result:
+            return result, (result['previous_cursor'], result['next_cursor'])
+        return result
+
+if __name__ == '__main__':
+    # benchmark parsing a users/lookup response of 100 users, JSONParser
+    # and then TweepyProxy.trim_users against projecting while decoding
+    import time
+    from api import TweepyProxy
+
+    def user(i):
+        return {
+            'id': i, 'id_str': str(i), 'name': 'User %s' % i,
+            'screen_name': 'user%s' % i, 'location': 'Somewhere',
+            'description': 'A description of user %s ' % i * 3,
+            'url': 'http://t.co/abcdef', 'protected': False,
+            'followers_count': 1234, 'friends_count': 567,
+            'listed_count': 12, 'created_at': 'Mon Jan 06 10:00:00 +0000 2014',
+            'favourites_count': 89, 'utc_offset': -18000,
+            'time_zone': 'Eastern Time (US & Canada)', 'geo_enabled': True,
+            'verified': False, 'statuses_count': 4321, 'lang': 'en',
+            'contributors_enabled': False, 'is_translator': False,
+            'profile_background_color': 'C0DEED',
+            'profile_background_image_url': 'http://abs.twimg.com/bg.png',
+            'profile_background_image_url_https': 'https://abs.twimg.com/bg.png',
+            'profile_background_tile': False,
+            'profile_image_url': 'http://pbs.twimg.com/profile_images/1/a.png',
+            'profile_image_url_https': 'https://pbs.twimg.com/profile_images/1/a.png',
+            'profile_link_color': '0084B4', 'profile_sidebar_border_color': 'C0DEED',
+            'profile_sidebar_fill_color': 'DDEEF6', 'profile_text_color': '333333',
+            'profile_use_background_image': True, 'default_profile': True,
+            'default_profile_image': False, 'following': False,
+            'follow_request_sent': False, 'notifications': False,
+            'entities': {'url': {'urls': [{'url': 'http://t.co/abcdef',
+                'expanded_url': 'http://example.com', 'indices': [0, 18]}]},
+                'description': {'urls': []}},
+            'status': {
+                'created_at': 'Tue Jan 07 10:00:00 +0000 2014',
+                'id': i * 1000, 'id_str': str(i * 1000),
+                'text': '@friend a tweet with a link http://t.co/xyz',
+                'source': '<a href="http://twitter.com">Twitter Web</a>',
+                'truncated': False, 'retweet_count': 3,
+                'favorite_count': 5, 'lang': 'en',
+                'entities': {'hashtags': [], 'symbols': [],
+                    'urls': [{'url': 'http://t.co/xyz',
+                              'expanded_url': 'http://example.com/x',
+                              'indices': [28, 43]}],
+                    'user_mentions': [{'screen_name': 'friend',
+                        'name': 'Friend', 'id': 42, 'id_str': '42',
+                        'indices': [0, 7]}]},
+            },
+        }
+
+    class Method(object):
+        payload_type = 'user'
+        parameters = {}
+
+    payload = json.dumps([user(i) for i in xrange(100)])
+    fields = TweepyProxy.USER_FIELDS
+    runs = 200
+
+    def timeit(parse):
+        start = time.time()
+        for i in xrange(runs):
+            parse()
+        return (time.time() - start) / runs * 1000
+
+    old = JSONParser()
+    print '100 users (%s KB)' % (len(payload) // 1024)
+    print '  JSONParser + trim_users:            %.2fms' % timeit(
+        lambda: TweepyProxy.trim_users(old.parse(Method, payload)))
+    print '  ProjectionParser (USER_FIELDS):      %.2fms' % timeit(
+        lambda: ProjectionParser(fields).parse(Method, payload))
+    print '  ProjectionParser (PROJECTED_FIELDS): %.2fms' % timeit(
+        lambda: ProjectionParser(TweepyProxy.PROJECTED_USER_FIELDS)\
+                .parse(Method, payload))
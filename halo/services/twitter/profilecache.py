@@ -0,0 +1,99 @@
+import time, threading
+from collections import OrderedDict
+
+class LRU(object):
+    """Least recently used cache of values that expire"""
+    def __init__(self, size=10000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None, now=None):
+        now = now or time.time()
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return default
+            if item[0] <= now:
+                return default
+            # most recently used last
+            self.items[key] = item
+            return item[1]
+
+    def set(self, key, value, ttl, now=None):
+        now = now or time.time()
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (now + ttl, value)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+MISSING = object()
+
+class ProfileCache(object):
+    """Caches (trimmed) user profiles by id for TweepyProxy's
+    ordered_lookup_users in an LRU, and in model (e.g.
+    models.CachedProfiles) to share them between processes. Users that
+    don't exist are cached as None for negative_ttl seconds.
+
+    Profiles are shared by every account so the fields that depend on who
+    looked the user up (VIEWER_FIELDS) aren't cached.
+    """
+    # whether the viewer follows the user, the last tweet of a protected
+    # user is only returned to followers
+    VIEWER_FIELDS = ('following', 'status')
+
+    def __init__(self, size=10000, ttl=24*60*60, negative_ttl=60*60,
+                 model=None):
+        self.lru = LRU(size)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.model = model
+
+    def get_many(self, ids):
+        """Returns {id: profile or None} of the cached ids"""
+        results = {}
+        misses = []
+
+        for id in ids:
+            profile = self.lru.get(id, MISSING)
+            if profile is MISSING:
+                misses.append(id)
+            else:
+                results[id] = profile
+
+        if misses and self.model is not None:
+            found = self.model.get_many(misses, self.ttl, self.negative_ttl)
+            # rows cached before VIEWER_FIELDS were stripped
+            found = dict((id, self.strip(profile)) \
+                         for id, profile in found.iteritems())
+            for id, profile in found.iteritems():
+                self.lru.set(id, profile, self.negative_ttl \
+                             if profile is None else self.ttl)
+            results.update(found)
+
+        return results
+
+    @classmethod
+    def strip(cls, profile):
+        """Copy of profile without the VIEWER_FIELDS"""
+        if profile is None:
+            return None
+        return dict((key, value) for key, value in profile.iteritems() \
+                    if not key in cls.VIEWER_FIELDS)
+
+    def set_many(self, profiles):
+        """profiles is {id: profile or None if the user doesn't exist}.
+        Returns the profiles as they're cached (stripped).
+        """
+        profiles = dict((id, self.strip(profile)) \
+                        for id, profile in profiles.iteritems())
+        for id, profile in profiles.iteritems():
+            self.lru.set(id, profile, self.negative_ttl \
+                         if profile is None else self.ttl)
+        if profiles and self.model is not None:
+            self.model.set_many(profiles)
+        return profiles
@@ -0,0 +1,143 @@
+import os, time, json, sqlite3, threading
+
+"""
+Rate limits shared by every TweepyProxy (in any process) that uses the same
+store, keyed by (account id, endpoint). A rate limit is a dict with limit,
+remaining and reset (unix time) like TweepyProxy.rate_limits.
+
+Every change is a read-modify-write done atomically by the backend's
+modify(), so acquire (decrement-and-check before a request) and update
+(from the response headers) are safe across processes.
+"""
+
+class RateLimitStore(object):
+    def modify(self, account_id, endpoint, func):
+        """Atomically call func(ratelimit or None) which returns (result, new
+        ratelimit or None to leave it unchanged). Returns result.
+        """
+        raise NotImplementedError
+
+    def get(self, account_id, endpoint):
+        return self.modify(account_id, endpoint, lambda ratelimit: \
+                           (ratelimit, None))
+
+    def acquire(self, account_id, endpoint, buffer=1, now=None):
+        """Take one request from the quota unless there's buffer or less
+        left before the reset. Returns (allowed, ratelimit).
+        """
+        now = now or time.time()
+
+        def take(ratelimit):
+            if not ratelimit or ratelimit.get('remaining') is None or \
+               not ratelimit.get('reset') > now:
+                # unknown or reset, the response will tell
+                return (True, ratelimit), None
+            if ratelimit['remaining'] <= buffer:
+                return (False, ratelimit), None
+            ratelimit = dict(ratelimit, remaining=ratelimit['remaining'] - 1)
+            return (True, ratelimit), ratelimit
+
+        return self.modify(account_id, endpoint, take)
+
+    def update(self, account_id, endpoint, ratelimit):
+        """Store ratelimit unless the stored one is fresher. Within the same
+        window the lower remaining wins, other processes may have acquired
+        requests that haven't been answered yet.
+        """
+        def merge(current):
+            new = ratelimit
+            if current and current.get('reset') is not None and \
+               new.get('reset') is not None:
+                if current['reset'] > new['reset']:
+                    return current, None
+                if current['reset'] == new['reset'] and \
+                   current.get('remaining') is not None and \
+                   new.get('remaining') is not None:
+                    new = dict(new, remaining=min(current['remaining'],
+                                                  new['remaining']))
+            return new, new
+
+        return self.modify(account_id, endpoint, merge)
+
+class MemoryRateLimitStore(RateLimitStore):
+    """Shared by the proxies of one process"""
+    def __init__(self):
+        self.ratelimits = {}
+        self.lock = threading.Lock()
+
+    def modify(self, account_id, endpoint, func):
+        key = (account_id, endpoint)
+        with self.lock:
+            result, ratelimit = func(self.ratelimits.get(key))
+            if ratelimit is not None:
+                self.ratelimits[key] = ratelimit
+        return result
+
+class SQLiteRateLimitStore(RateLimitStore):
+    """Shared by the processes of one host through a SQLite file (use a
+    local disk, not NFS).
+    """
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        # connections can't be shared by threads or forked processes
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or not self.local.pid == os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute('CREATE TABLE IF NOT EXISTS rate_limits (' \
+                         'account_id INTEGER, endpoint TEXT, data TEXT, ' \
+                         'PRIMARY KEY (account_id, endpoint))')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def modify(self, account_id, endpoint, func):
+        conn = self.connection()
+        # take the write lock up front so the read can't go stale
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM rate_limits WHERE ' \
+                               'account_id=? AND endpoint=?',
+                               (account_id, endpoint)).fetchone()
+            result, ratelimit = func(json.loads(row[0]) if row else None)
+            if ratelimit is not None:
+                conn.execute('INSERT OR REPLACE INTO rate_limits VALUES ' \
+                             '(?, ?, ?)', (account_id, endpoint,
+                                           json.dumps(ratelimit)))
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return result
+
+class RedisRateLimitStore(RateLimitStore):
+    """Shared by every host. client is a redis.StrictRedis (or anything
+    with the same transaction/pipeline interface, e.g. fakeredis). Keys
+    expire a minute after the reset.
+    """
+    def __init__(self, client, prefix='ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+
+    def modify(self, account_id, endpoint, func):
+        key = '%s%s:%s' % (self.prefix, account_id, endpoint)
+        results = []
+
+        def transaction(pipe):
+            # WATCHed by client.transaction, retried if key changes
+            data = pipe.get(key)
+            result, ratelimit = func(json.loads(data) if data else None)
+            del results[:]
+            results.append(result)
+            if ratelimit is not None:
+                pipe.multi()
+                pipe.set(key, json.dumps(ratelimit))
+                if ratelimit.get('reset'):
+                    pipe.expireat(key, int(ratelimit['reset']) + 60)
+
+        self.client.transaction(transaction, key)
+        return results[0]
@@ -125,6 +125,9 @@ def _dthandler(obj):
     if isinstance(obj, Model):
         if hasattr(obj, '__jsonify__'):
             return obj.__jsonify__()
+    if hasattr(obj, 'tolist'):
+        # arrays and ring buffers
+        return obj.tolist()
 
 def jsonify(__model__=None, **data):
     """Like flask's jsonify but status code of response can be set,
@@ -0,0 +1,279 @@
+import time, socket, httplib, urllib2, logging, threading
+from collections import defaultdict
+from urlparse import urlsplit
+from StringIO import StringIO
+
+"""
+Keep-alive HTTP(S) connections shared by everything in the process that
+talks to a third party API. Connections are pooled per (scheme, host, port),
+reused while they're idle for less than idle_timeout, and at most
+max_connections idle connections are kept per host. Connections that
+aren't given back (e.g. tweepy doesn't close them on errors) are simply
+never reused. Safe to use from threads and (monkey patched) greenlets.
+
+    response = http.urlopen('https://buy.itunes.apple.com/verifyReceipt',
+                            data)
+
+tweepy and python-instagram make their own connections, patch_tweepy and
+patch_instagram route them through a pool. pool.stats counts hits (an idle
+connection was reused), misses (a new connection was opened), and expired,
+discarded and retried connections.
+"""
+
+# errors of a kept alive connection the server has closed
+STALE_ERRORS = (socket.error, httplib.BadStatusLine,
+                httplib.CannotSendRequest, httplib.ResponseNotReady)
+
+# requests that can be sent again if the response couldn't be read, the
+# server may have processed the request (e.g. a POST) before closing
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+class ConnectionPool(object):
+    def __init__(self, max_connections=10, idle_timeout=60, timeout=60):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)
+        self.stats = defaultdict(int)
+
+    def _count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def get(self, scheme, host, port=None, timeout=None):
+        """Returns (connection, whether it was reused). Give it back with
+        put once the response has been read.
+        """
+        key = (scheme, host, port)
+        now = time.time()
+        with self.lock:
+            idle = self.idle[key]
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    self.stats['hits'] += 1
+                    return conn, True
+                self.stats['expired'] += 1
+                conn.close()
+            self.stats['misses'] += 1
+
+        return self.connect(scheme, host, port, timeout), False
+
+    def connect(self, scheme, host, port=None, timeout=None):
+        cls = httplib.HTTPSConnection if scheme == 'https' else \
+                httplib.HTTPConnection
+        return cls(host, port, timeout=timeout or self.timeout)
+
+    def put(self, scheme, host, port, conn):
+        idle = self.idle[(scheme, host, port)]
+        with self.lock:
+            if len(idle) < self.max_connections:
+                idle.append((conn, time.time()))
+                return
+            self.stats['discarded'] += 1
+        conn.close()
+
+    def connection(self, scheme, host, port=None, timeout=None):
+        return PooledConnection(self, scheme, host, port, timeout)
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """Returns a Response with the body read"""
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        conn = self.connection(parts.scheme, parts.hostname, parts.port,
+                               timeout)
+        try:
+            conn.request(method, path, body, headers or {})
+            response = conn.getresponse()
+            return Response(url, response, response.read())
+        finally:
+            conn.close()
+
+    def urlopen(self, url, data=None, timeout=None):
+        """Like urllib2.urlopen (url may be a urllib2.Request), raises
+        urllib2.HTTPError if the status isn't 2xx.
+        """
+        headers = {}
+        if isinstance(url, urllib2.Request):
+            headers.update(url.unredirected_hdrs)
+            headers.update(url.headers)
+            data = url.get_data() if data is None else data
+            url = url.get_full_url()
+
+        method = 'POST' if data is not None else 'GET'
+        if data is not None and not 'Content-type' in headers:
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+
+        response = self.request(method, url, data, headers, timeout)
+
+        if not 200 <= response.status < 300:
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, StringIO(response.data))
+
+        return response
+
+class PooledConnection(object):
+    """Stands in for an httplib connection. close() gives the connection
+    back to the pool if the response was read and can be kept alive. A
+    request on a reused connection the server has since closed is retried
+    once on a new connection if sending it failed, or if reading the
+    response failed and the method is idempotent.
+    """
+    def __init__(self, pool, scheme, host, port=None, timeout=None):
+        self.pool = pool
+        self.key = (scheme, host, port)
+        self.timeout = timeout
+        self.conn = None
+        self.reused = False
+        self.response = None
+        self.args = None
+
+    def _acquire(self):
+        if self.conn is None:
+            self.conn, self.reused = self.pool.get(*self.key,
+                                                   timeout=self.timeout)
+
+    def _retry(self):
+        logging.debug('Retrying request on a new connection to %s' % \
+                      self.key[1])
+        self.pool._count('retries')
+        self.conn.close()
+        self.conn = self.pool.connect(*self.key, timeout=self.timeout)
+        self.reused = False
+        self.conn.request(*self.args[0], **self.args[1])
+
+    def request(self, *args, **kwargs):
+        self._acquire()
+        self.args = (args, kwargs)
+        try:
+            self.conn.request(*args, **kwargs)
+        except STALE_ERRORS:
+            if not self.reused:
+                raise
+            self._retry()
+
+    def getresponse(self):
+        try:
+            self.response = self.conn.getresponse()
+        except STALE_ERRORS:
+            args, kwargs = self.args
+            method = args[0] if args else kwargs.get('method')
+            if not self.reused or not method in IDEMPOTENT_METHODS:
+                raise
+            self._retry()
+            self.response = self.conn.getresponse()
+        return self.response
+
+    def close(self):
+        if self.conn is None:
+            return
+
+        conn, self.conn = self.conn, None
+        if self.response is not None and self.response.isclosed() and \
+           not self.response.will_close:
+            self.pool.put(self.key[0], self.key[1], self.key[2], conn)
+        else:
+            conn.close()
+
+    def __getattr__(self, name):
+        self._acquire()
+        return getattr(self.conn, name)
+
+class Response(object):
+    """Response whose body has been read, file like like urllib2's"""
+    def __init__(self, url, response, data):
+        self.url = url
+        self.status = self.code = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self.headers = dict(response.getheaders())
+        self.data = data
+        self.fp = StringIO(data)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def info(self):
+        return self.msg
+
+    def geturl(self):
+        return self.url
+
+    def read(self, *args):
+        return self.fp.read(*args)
+
+    def close(self):
+        pass
+
+default_pool = ConnectionPool()
+
+def request(method, url, body=None, headers=None, timeout=None):
+    return default_pool.request(method, url, body, headers, timeout)
+
+def urlopen(url, data=None, timeout=None):
+    return default_pool.urlopen(url, data, timeout)
+
+#
+# LIBRARY PATCHES
+#
+
+class HTTPLib(object):
+    """Stand in for the httplib module with pooled connections"""
+    def __init__(self, pool):
+        self.pool = pool
+
+    def HTTPConnection(self, host, port=None, strict=None, timeout=None):
+        return self.pool.connection('http', host, port, timeout)
+
+    def HTTPSConnection(self, host, port=None, key_file=None,
+                        cert_file=None, strict=None, timeout=None):
+        return self.pool.connection('https', host, port, timeout)
+
+    def __getattr__(self, name):
+        return getattr(httplib, name)
+
+class Http(object):
+    """Stand in for httplib2.Http with pooled connections. Responses are
+    dicts of the headers with status (like httplib2.Response).
+    """
+    def __init__(self, pool, *args, **kwargs):
+        self.pool = pool
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        response = self.pool.request(method, uri, body, headers)
+        result = HttpResponse(response.headers)
+        result.status = response.status
+        result.reason = response.reason
+        result['status'] = str(response.status)
+        return result, response.data
+
+class HttpResponse(dict):
+    status = 200
+    reason = 'Ok'
+
+def patch_tweepy(pool=None):
+    """Route tweepy's API requests (made with httplib) and OAuth requests
+    (made with urllib2) through pool.
+    """
+    pool = pool or default_pool
+    try:
+        import tweepy.binder, tweepy.auth
+    except ImportError:
+        return
+    tweepy.binder.httplib = HTTPLib(pool)
+    if hasattr(tweepy.auth, 'urlopen'):
+        tweepy.auth.urlopen = pool.urlopen
+
+def patch_instagram(pool=None):
+    """Route python-instagram's requests (made with httplib2) through pool.
+    """
+    pool = pool or default_pool
+    try:
+        import instagram.oauth2
+    except ImportError:
+        return
+    instagram.oauth2.Http = lambda *args, **kwargs: Http(pool)
@@ -0,0 +1,435 @@
+import heapq
+from array import array
+from bisect import bisect_left
+from itertools import islice
+
+try:
+    import numpy
+except ImportError:
+    pass
+
+"""
+Compact encoding for large lists of numeric ids (e.g. twitter follower ids).
+
+Packed format (version 1):
+
+    \\x01 | varint(count) | varint(zigzag(id[0])) | varint(zigzag(id[1]-id[0])) ...
+
+Deltas are zigzag encoded so that unsorted lists (relationship lists are
+ordered by when an id was first seen, not numerically) still pack well.
+"""
+
+PACKED_VERSION = '\x01'
+
+# python 2 arrays have no 'Q', 'L' is an unsigned 64 bit int on LP64 platforms
+ID_TYPECODE = 'L'
+
+#
+# VARINT CODEC
+#
+
+def zigzag(n):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+def unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+def write_varint(buf, n):
+    """Append unsigned n to bytearray buf"""
+    while n > 0x7f:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+def read_varint(data, offset):
+    """Returns the varint at offset in bytearray data and the offset after it.
+    """
+    result = shift = 0
+    while True:
+        b = data[offset]
+        offset += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, offset
+        shift += 7
+
+def pack_ids(ids):
+    """Pack a sequence of ints into a delta encoded byte string. ids may be
+    strings of digits.
+    """
+    buf = bytearray(PACKED_VERSION)
+    body = bytearray()
+    count = prev = 0
+
+    for id in ids:
+        id = int(id)
+        write_varint(body, zigzag(id - prev))
+        prev = id
+        count += 1
+
+    write_varint(buf, count)
+    buf.extend(body)
+    return str(buf)
+
+def unpack_header(data):
+    """Returns (count, offset of first id) of packed data"""
+    data = bytearray(data[:10])
+    if not data:
+        return 0, 0
+    assert data[0] == ord(PACKED_VERSION), 'Unknown packed ids version'
+    return read_varint(data, 1)
+
+def iter_packed(data, convert=None):
+    """Lazily decode packed ids"""
+    count, offset = unpack_header(data)
+    data = bytearray(data)
+    prev = 0
+
+    for i in xrange(count):
+        delta, offset = read_varint(data, offset)
+        prev += unzigzag(delta)
+        yield convert(prev) if convert else prev
+
+def unpack_ids(data, convert=None):
+    return list(iter_packed(data, convert))
+
+#
+# CONTAINERS
+#
+
+class PackedIds(object):
+    """List-like view of packed ids that is only decoded as far as needed.
+    Any mutation decodes the whole list once, after which it behaves like a
+    plain list. Unmodified ids are written back without re-encoding.
+    """
+    def __init__(self, data='', convert=None):
+        self._data = data
+        self._convert = convert
+        self._ids = None
+        self._count = unpack_header(data)[0] if data else 0
+
+    def _materialize(self):
+        if self._ids is None:
+            self._ids = list(iter_packed(self._data, self._convert))
+        return self._ids
+
+    def packed(self):
+        if self._ids is None:
+            return self._data
+        return pack_ids(self._ids)
+
+    def tolist(self):
+        return list(self._materialize())
+
+    def __len__(self):
+        if self._ids is not None:
+            return len(self._ids)
+        return self._count
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        if self._ids is not None:
+            return iter(self._ids)
+        return iter_packed(self._data, self._convert)
+
+    def __getitem__(self, key):
+        if self._ids is not None:
+            return self._ids[key]
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._count)
+            if step < 0:
+                return self._materialize()[key]
+            return list(islice(iter(self), start, stop, step))
+
+        if key < 0:
+            key += self._count
+        if not 0 <= key < self._count:
+            raise IndexError('list index out of range')
+        return next(islice(iter(self), key, None))
+
+    def __contains__(self, id):
+        return any(i == id for i in self)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, PackedIds)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'PackedIds(%r)' % (self[:10] + (['...'] if len(self) > 10 else []))
+
+    # mutations decode the full list
+
+    def __setitem__(self, key, value):
+        self._materialize()[key] = value
+
+    def __delitem__(self, key):
+        del self._materialize()[key]
+
+    def index(self, id):
+        return self._materialize().index(id)
+
+    def insert(self, index, id):
+        self._materialize().insert(index, id)
+
+    def remove(self, id):
+        self._materialize().remove(id)
+
+    def append(self, id):
+        self._materialize().append(id)
+
+    def extend(self, ids):
+        self._materialize().extend(ids)
+
+    def pop(self, index=-1):
+        return self._materialize().pop(index)
+
+#
+# SORTED ARRAYS
+#
+
+def id_array(ids=()):
+    return array(ID_TYPECODE, ids)
+
+def _iter_range(arr, start, end):
+    for i in xrange(start, end):
+        yield arr[i]
+
+def sorted_id_array(pages):
+    """Collect pages of ids (ints or strings of digits) into one sorted
+    array. Pages are sorted one at a time and then merged so peak memory
+    stays around twice the size of the array.
+    """
+    arr = id_array()
+    runs = []
+
+    for page in pages:
+        start = len(arr)
+        arr.extend(sorted(int(id) for id in page))
+        runs.append((start, len(arr)))
+
+    if len(runs) <= 1:
+        return arr
+
+    return id_array(heapq.merge(
+        *[_iter_range(arr, start, end) for start, end in runs]))
+
+def sort_id_array(arr, run_length=5000):
+    """Sort an array of ids, sorting runs of it in place and then merging
+    them like sorted_id_array.
+    """
+    n = len(arr)
+    for start in xrange(0, n, run_length):
+        arr[start:start+run_length] = id_array(
+            sorted(arr[start:start+run_length]))
+
+    if n <= run_length:
+        return arr
+
+    return id_array(heapq.merge(
+        *[_iter_range(arr, start, min(start + run_length, n)) \
+          for start in xrange(0, n, run_length)]))
+
+def sorted_contains(arr, id):
+    i = bisect_left(arr, id)
+    return i < len(arr) and arr[i] == id
+
+def sorted_difference(a, b):
+    """Yields the items of sorted a that aren't in sorted b"""
+    j, n = 0, len(b)
+    for id in a:
+        while j < n and b[j] < id:
+            j += 1
+        if j == n or not b[j] == id:
+            yield id
+
+def sorted_intersection(a, b):
+    """Yields the items of sorted a that are also in sorted b"""
+    j, n = 0, len(b)
+    for id in a:
+        while j < n and b[j] < id:
+            j += 1
+        if j == n:
+            return
+        if b[j] == id:
+            yield id
+
+#
+# ORDERED MERGE
+#
+
+def ordered_merge(fresh, cached_list=None, new_index=0):
+    """Returns (ids, old_ids, new_index) where ids is cached_list without the
+    ids that aren't in fresh and with the ids of fresh it doesn't contain
+    prepended, old_ids are the removed ids and new_index is the index of the
+    first id that isn't new. Arrays are merged with numpy when available.
+    Like the oset merge it replaces, duplicates in cached_list are dropped
+    (but an unchanged list is returned as is).
+    """
+    if cached_list is None:
+        return list(fresh), set(), 0
+
+    if 'numpy' in globals() and isinstance(fresh, (array, numpy.ndarray)):
+        return numpy_ordered_merge(fresh, cached_list, new_index)
+
+    if not isinstance(fresh, (set, frozenset)):
+        fresh = set(fresh)
+
+    results = []
+    old_ids = set()
+    keep = results.append
+    remove = old_ids.add
+
+    for id in cached_list:
+        if id in fresh:
+            keep(id)
+        else:
+            remove(id)
+
+    new = fresh.difference(results)
+    if not new and not old_ids:
+        return cached_list, old_ids, new_index
+
+    if len(results) + len(new) > len(fresh):
+        # cached_list has duplicates, keep the first of each
+        seen = set()
+        results = [id for id in results if not (id in seen or seen.add(id))]
+        if new_index:
+            new_index = len(fresh.intersection(islice(cached_list, new_index)))
+    elif new_index and old_ids:
+        new_index = sum(1 for id in islice(cached_list, new_index) \
+                        if id in fresh)
+
+    return list(new) + results, old_ids, len(new) + new_index
+
+def _ndarray(ids):
+    if isinstance(ids, numpy.ndarray):
+        return ids
+    if isinstance(ids, array) and ids.itemsize == 8:
+        return numpy.frombuffer(ids, dtype=numpy.uint64)
+    return numpy.fromiter((int(id) for id in ids), numpy.uint64, len(ids))
+
+def _isin(ids, order, sorted_ids):
+    """Vectorized membership test of ids in sorted_ids. order is the argsort
+    of ids (searching sorted values is much more cache friendly).
+    """
+    found = numpy.zeros(len(ids), dtype=bool)
+    if len(sorted_ids):
+        ids = ids[order]
+        i = numpy.searchsorted(sorted_ids, ids)
+        i[i == len(sorted_ids)] = 0
+        found[order] = sorted_ids[i] == ids
+    return found
+
+def _has_duplicates(sorted_ids):
+    return bool(numpy.any(sorted_ids[1:] == sorted_ids[:-1]))
+
+def _first_unique(ids):
+    """ids without the repeats of an id, in order"""
+    first = numpy.unique(ids, return_index=True)[1]
+    return ids[numpy.sort(first)]
+
+def numpy_ordered_merge(fresh, cached_list, new_index=0):
+    """Vectorized ordered_merge for integer ids. Returns ids and old_ids as
+    numpy arrays.
+    """
+    fresh = _ndarray(fresh)
+    cached = _ndarray(cached_list)
+    fresh_order = numpy.argsort(fresh)
+    cached_order = numpy.argsort(cached)
+    sorted_fresh = fresh[fresh_order]
+    sorted_cached = cached[cached_order]
+
+    kept = _isin(cached, cached_order, sorted_fresh)
+    old_ids = cached[~kept]
+    new = fresh[~_isin(fresh, fresh_order, sorted_cached)]
+
+    if not len(new) and not len(old_ids):
+        return cached, old_ids, new_index
+
+    results = cached[kept]
+    if _has_duplicates(sorted_fresh):
+        new = _first_unique(new)
+    if _has_duplicates(sorted_cached):
+        results = _first_unique(results)
+        if new_index:
+            new_index = len(numpy.unique(cached[:new_index][kept[:new_index]]))
+    elif new_index:
+        new_index = int(numpy.count_nonzero(kept[:new_index]))
+
+    return numpy.concatenate((new, results)), old_ids, len(new) + new_index
+
+if __name__ == '__main__':
+    # benchmark against the oset based merge Relationships used to do
+    import random, time
+    from oset import oset
+
+    def oset_merge(fresh_set, cached_list=None, new_index=0):
+        cached_set = set(cached_list)
+        if fresh_set == cached_set:
+            return cached_list, set(), new_index
+
+        new_set = fresh_set - cached_set
+        old_set = cached_set - fresh_set
+
+        if new_index:
+            new_index = len(set(cached_list[:new_index]) - old_set)
+
+        results = oset(cached_list) - old_set
+        return list(new_set) + list(results), old_set, len(new_set) + new_index
+
+    def check(fresh, cached, new_index):
+        """ordered_merge gives the same result as the oset merge, new ids
+        are prepended in set order so they're compared as sets.
+        """
+        expected = oset_merge(set(fresh), cached, new_index)
+        results = [ordered_merge(set(fresh), cached, new_index)]
+        if 'numpy' in globals():
+            ids, old_ids, index = ordered_merge(id_array(fresh),
+                                                id_array(cached), new_index)
+            results.append((ids.tolist(), set(old_ids.tolist()), index))
+
+        new = len(set(fresh) - set(cached))
+        for ids, old_ids, index in results:
+            assert set(ids[:new]) == set(expected[0][:new]), (fresh, cached)
+            assert list(ids[new:]) == list(expected[0][new:]), (fresh, cached)
+            assert set(old_ids) == expected[1], (fresh, cached)
+            assert index == expected[2], (fresh, cached, new_index)
+
+    check([1, 2, 3], [1, 1, 2], 0)
+    check([1, 2], [1, 1, 2], 1)
+    check([2, 3], [1, 2, 2, 1], 3)
+    for i in xrange(5000):
+        cached = [random.randint(1, 20) for j in xrange(random.randint(1, 15))]
+        fresh = [random.randint(1, 20) for j in xrange(random.randint(0, 15))]
+        check(fresh, cached, random.randint(0, len(cached)))
+    print 'ordered_merge matches the oset merge'
+
+    def timeit(func, *args):
+        start = time.time()
+        func(*args)
+        return time.time() - start
+
+    for n in (10000, 100000, 1000000):
+        cached = random.sample(xrange(1, 1 << 62), n)
+        # 1% churn
+        churn = n // 100
+        fresh = cached[churn:] + random.sample(xrange(1, 1 << 62), churn)
+        cached_str = [str(id) for id in cached]
+        fresh_str = set(str(id) for id in fresh)
+
+        print '%7s ids  oset: %.3fs  ordered_merge: %.3fs' % (n,
+            timeit(oset_merge, fresh_str, cached_str, churn * 2),
+            timeit(ordered_merge, fresh_str, cached_str, churn * 2)),
+
+        if 'numpy' in globals():
+            print ' numpy: %.3fs' % timeit(ordered_merge,
+                id_array(fresh), id_array(cached), churn * 2)
+        else:
+            print
@@ -1,5 +1,6 @@
 import logging
-import urllib2, base64, json
+import base64, json
+from halo.util import http
 
 """
 Sample response from app verification url:
@@ -51,9 +52,8 @@ def verify(receipt, sandbox=False, sandbox_fallback=True):
     encoded_receipt = base64.b64encode(receipt)
     data = json.dumps({'receipt-data': encoded_receipt})
 
-    response = urllib2.urlopen(url, data)
+    response = http.urlopen(url, data)
     result = json.loads(response.read())
-    response.close()
 
     # retry if receipt for wrong server (apple review process uses sandbox)
     if result['status'] in [21008, 21007] and sandbox_fallback:
@@ -0,0 +1,122 @@
+import struct
+from array import array
+
+"""
+Fixed capacity series of int32 values (None is stored as a sentinel) that
+packs into a small byte string:
+
+    version (uint8) | head (uint16) | length (uint16) | capacity * int32
+
+Appending past capacity overwrites the oldest value in O(1).
+"""
+
+MISSING = -2 ** 31
+VERSION = 1
+HEADER = struct.Struct('<BHH')
+
+class RingBuffer(object):
+    def __init__(self, capacity, values=None):
+        self.capacity = capacity
+        self.reset(values or [])
+
+    @classmethod
+    def from_bytes(cls, data, capacity=None):
+        version, head, length = HEADER.unpack_from(data)
+        assert version == VERSION, 'Unknown RingBuffer version'
+        slots = array('i')
+        slots.fromstring(data[HEADER.size:])
+        assert slots.itemsize == 4
+
+        buf = cls(len(slots))
+        buf.head = head
+        buf.length = length
+        buf.slots = slots
+
+        if capacity is not None and not capacity == buf.capacity:
+            # capacity changed so repack
+            buf = cls(capacity, buf.tolist()[-capacity:])
+
+        return buf
+
+    def to_bytes(self):
+        return HEADER.pack(VERSION, self.head, self.length) + \
+                self.slots.tostring()
+
+    def reset(self, values):
+        self.slots = array('i', [MISSING] * self.capacity)
+        self.head = 0
+        self.length = 0
+        for value in values[-self.capacity:]:
+            self.append(value)
+
+    def _index(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('RingBuffer index out of range')
+        return (self.head + i) % self.capacity
+
+    def append(self, value):
+        """Returns the value that was pushed out, or None"""
+        value = MISSING if value is None else value
+
+        if self.length < self.capacity:
+            self.slots[(self.head + self.length) % self.capacity] = value
+            self.length += 1
+            return None
+
+        evicted = self.slots[self.head]
+        self.slots[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        return None if evicted == MISSING else evicted
+
+    def popleft(self):
+        value = self[0]
+        self.head = (self.head + 1) % self.capacity
+        self.length -= 1
+        return value
+
+    def tolist(self):
+        return list(self)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        slots, capacity = self.slots, self.capacity
+        for i in xrange(self.head, self.head + self.length):
+            value = slots[i % capacity]
+            yield None if value == MISSING else value
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.tolist()[i]
+        value = self.slots[self._index(i)]
+        return None if value == MISSING else value
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            values = self.tolist()
+            values[i] = value
+            self.reset(values)
+        else:
+            self.slots[self._index(i)] = MISSING if value is None else value
+
+    def __delitem__(self, i):
+        if i == 0:
+            self.popleft()
+        else:
+            values = self.tolist()
+            del values[i]
+            self.reset(values)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, RingBuffer)):
+            return NotImplemented
+        return self.tolist() == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'RingBuffer(%s, %r)' % (self.capacity, self.tolist())